@@ -30,6 +30,7 @@ setup(
     packages=find_packages(exclude=['contrib', 'docs', 'tests']),
     include_package_data=True,
     install_requires=['psycopg2-binary', 'requests'],
+    extras_require={'numpy': ['numpy']},
     python_requires='>=3.4',
     entry_points={
         'console_scripts': [
@@ -2,8 +2,11 @@ from .version import __version__
 from sumav.graph.builder import SumavGraphBuilder
 from sumav.graph.manager import SumavGraphManager
 from sumav.graph.searcher import SumavGraphSearcher
+from sumav.graph.asyncsearcher import SumavGraphAsyncSearcher
+from sumav.graph.server import SumavGraphServer
 from sumav.preprocessing.from_vt_filefeed import FromVirusTotalFileFeed
 from sumav.preprocessing.from_vt_api_v2 import FromVirusTotalAPIv2
 
 __all__ = ['SumavGraphBuilder', 'SumavGraphManager', 'SumavGraphSearcher',
+           'SumavGraphAsyncSearcher', 'SumavGraphServer',
            'FromVirusTotalFileFeed', 'FromVirusTotalAPIv2']
@@ -16,6 +16,16 @@ intersection_ratio = float(os.environ.get('INTERSECTION_RATIO', '0.9'))
 wait_for_reconnection = int(os.environ.get('WAIT_FOR_RECONNECTION', 60))
 worker_concurrency = int(os.environ.get('WORKER_CONCURRENCY', (
     os.cpu_count() if os.cpu_count() <= 8 else os.cpu_count() / 2)))
+build_memory_limit = float(os.environ.get('BUILD_MEMORY_LIMIT', 0))
+build_checkpoint = os.environ.get('BUILD_CHECKPOINT', None)
+graph_snapshot = os.environ.get('GRAPH_SNAPSHOT', None)
+result_cache_size = int(os.environ.get('RESULT_CACHE_SIZE', 0))
+result_cache_memory = float(os.environ.get('RESULT_CACHE_MEMORY', 0))
+graph_channel = os.environ.get('GRAPH_CHANNEL', 'sumav_graph')
+graph_poll_interval = float(os.environ.get('GRAPH_POLL_INTERVAL', 60))
+serve_host = os.environ.get('SERVE_HOST', '127.0.0.1')
+serve_port = int(os.environ.get('SERVE_PORT', 8470))
+async_connections = int(os.environ.get('ASYNC_CONNECTIONS', 8))
 vt_apikey = os.environ.get('VT_APIKEY', None)
 
 
@@ -12,7 +12,8 @@ from pprint import pprint
 # Internal packages
 import sumav.conf as conf
 from sumav import (SumavGraphBuilder, SumavGraphManager, SumavGraphSearcher,
-                   FromVirusTotalFileFeed, FromVirusTotalAPIv2)
+                   SumavGraphServer, FromVirusTotalFileFeed,
+                   FromVirusTotalAPIv2)
 from sumav.version import __version__
 
 logger = logging.getLogger(__name__)
@@ -45,6 +46,39 @@ $ sumav run select '["PUP/Win32.Dealply.C3316715", "Win32:DealPly-AJ [Adw]"\
 
     psr_cm_bu = subpsr_cm.add_parser('build')
     psr_cm_bu.add_argument('-p', '--preprocess-only', action='store_true')
+    psr_cm_bu.add_argument(
+        '-i', '--incremental', action='store_true',
+        help='add detections inserted after the last build to the graph '
+             'instead of building whole graph.')
+    psr_cm_bu.add_argument(
+        '--processes', type=int, default=conf.worker_concurrency,
+        help='number of processes to count nodes and edges. '
+             '(default: %s)' % conf.worker_concurrency)
+    psr_cm_bu.add_argument(
+        '--mode', choices=['python', 'sql'], default='python',
+        help='count nodes and edges in python processes or inside '
+             'PostgreSQL. (default: python)')
+    psr_cm_bu.add_argument(
+        '--single-pass', action='store_true',
+        help='count nodes and edges by scanning detections once. it takes '
+             'more memory to count edges of rare tokens.')
+    psr_cm_bu.add_argument(
+        '--dedup', action='store_true',
+        help='count detections having the same tokens at once.')
+    psr_cm_bu.add_argument(
+        '--snapshot', default=conf.graph_snapshot,
+        help='file to write a snapshot of the graph that searchers map in '
+             'memory. (default: %s)' % conf.graph_snapshot)
+    psr_cm_bu.add_argument(
+        '--checkpoint', default=conf.build_checkpoint,
+        help='file saving each finished step of the build. an unfinished '
+             'build is resumed from the file. (default: %s)' %
+             conf.build_checkpoint)
+    psr_cm_bu.add_argument(
+        '--memory-limit', type=float, default=conf.build_memory_limit,
+        help='megabytes of edge counts kept in memory. counts over the '
+             'limit are spilled to temporary files. 0 means no limit. '
+             '(default: %s)' % conf.build_memory_limit)
     subpsr_cm_bu_da = psr_cm_bu.add_subparsers(dest='datatype',
                                                help='preprocess data from')
 
@@ -57,6 +91,8 @@ $ sumav run select '["PUP/Win32.Dealply.C3316715", "Win32:DealPly-AJ [Adw]"\
                                                help='command to run')
 
     subpsr_cm_mi_ac.add_parser('dump_graph')
+    subpsr_cm_mi_ac.add_parser(
+        'rollback_graph', help='restore the graph of the previous build')
 
     psr_cm_mi_ac_pu = subpsr_cm_mi_ac.add_parser('pull_dumped_graph')
     psr_cm_mi_ac_pu.add_argument('-H', '--host', required=True)
@@ -101,6 +137,30 @@ $ sumav run select '["PUP/Win32.Dealply.C3316715", "Win32:DealPly-AJ [Adw]"\
     psr_cm_ru_me_si = subpsr_cm_ru_me.add_parser('similar')
     psr_cm_ru_me_si.add_argument('token', nargs=1)
 
+    psr_cm_se = subpsr_cm.add_parser(
+        'serve', help='serve the run methods over HTTP/JSON')
+    psr_cm_se.add_argument(
+        '-H', '--host', default=conf.serve_host,
+        help='(default: %s)' % conf.serve_host)
+    psr_cm_se.add_argument(
+        '-P', '--port', type=int, default=conf.serve_port,
+        help='(default: %s)' % conf.serve_port)
+    psr_cm_se.add_argument(
+        '-u', '--unix-socket',
+        help='path of a unix socket to listen to instead of host and port.')
+    psr_cm_se.add_argument(
+        '--batch-size', type=int, default=1000,
+        help='samples of concurrent requests labeled at once. '
+             '(default: 1000)')
+    psr_cm_se.add_argument(
+        '--batch-wait', type=float, default=0,
+        help='seconds to wait for more requests before labeling a batch. '
+             '(default: 0)')
+    psr_cm_se.add_argument(
+        '--snapshot', default=conf.graph_snapshot,
+        help='snapshot of the graph to map in memory. (default: %s)' %
+             conf.graph_snapshot)
+
     ns = psr.parse_args(argv)
     cmd_args = vars(ns)
 
@@ -143,7 +203,14 @@ $ sumav run select '["PUP/Win32.Dealply.C3316715", "Win32:DealPly-AJ [Adw]"\
         else:
             # Build graph
             builder = SumavGraphBuilder(**conf.psql_conf)
-            builder.build_graph()
+            builder.build_graph(incremental=cmd_args['incremental'],
+                                processes=cmd_args['processes'],
+                                mode=cmd_args['mode'],
+                                memory_limit=cmd_args['memory_limit'],
+                                single_pass=cmd_args['single_pass'],
+                                checkpoint=cmd_args['checkpoint'],
+                                dedup=cmd_args['dedup'],
+                                snapshot=cmd_args['snapshot'])
             builder.close()
 
         return
@@ -170,6 +237,11 @@ $ sumav run select '["PUP/Win32.Dealply.C3316715", "Win32:DealPly-AJ [Adw]"\
             elif cmd_args['action'] == 'get_dumped_graph_names':
                 pprint(manager.pull_sumav_graph_lists(**kwargs))
 
+            elif cmd_args['action'] == 'rollback_graph':
+                builder = SumavGraphBuilder(**conf.psql_conf)
+                builder.rollback_graph()
+                builder.close()
+
             else:
                 psr_cm_mi.print_help()
 
@@ -210,6 +282,24 @@ $ sumav run select '["PUP/Win32.Dealply.C3316715", "Win32:DealPly-AJ [Adw]"\
             searcher.close()
         return
 
+    elif command == 'serve':
+        searcher = SumavGraphSearcher(**conf.psql_conf,
+                                      snapshot=cmd_args['snapshot'])
+        server = SumavGraphServer(searcher, host=cmd_args['host'],
+                                  port=cmd_args['port'],
+                                  unix_socket=cmd_args['unix_socket'],
+                                  batch_size=cmd_args['batch_size'],
+                                  batch_wait=cmd_args['batch_wait'])
+        try:
+            searcher.watch_graph()
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            searcher.close()
+        return
+
     psr.print_help()
 
 
@@ -18,6 +18,53 @@ from psycopg2.extras import RealDictRow
 logger = logging.getLogger(__name__)
 
 
+class _CopyRowsReader:
+    '''File-like object streaming rows in the text format of COPY'''
+    __escapes = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n',
+                               '\r': '\\r'})
+
+    def __init__(self, rows, table, log_every=100000):
+        self.__rows = iter(rows)
+        self.__table = table
+        self.__log_every = log_every
+        self.__buf = ''
+        self.rowcount = 0
+
+    def read(self, size=-1):
+        lines = [self.__buf]
+        length = len(self.__buf)
+        while size < 0 or length < size:
+            row = next(self.__rows, None)
+            if row is None:
+                break
+
+            line = '\t'.join([self.__format(v) for v in row]) + '\n'
+            lines.append(line)
+            length += len(line)
+            self.rowcount += 1
+            if self.rowcount % self.__log_every == 0:
+                logger.info('%9s rows copied to %s.' %
+                            (self.rowcount, self.__table))
+
+        data = ''.join(lines)
+        if size < 0:
+            size = len(data)
+        self.__buf = data[size:]
+        return data[:size]
+
+    def __format(self, val):
+        if val is None:
+            return '\\N'
+        elif isinstance(val, (list, tuple)):
+            val = '{%s}' % ','.join([
+                '"%s"' % str(v).replace('\\', '\\\\').replace('"', '\\"')
+                for v in val])
+        else:
+            val = str(val)
+
+        return val.translate(self.__escapes)
+
+
 class SumavPostgresConnector:
     def __init__(self, user, password, database, host, port):
         '''Connect to Sumav RDB
@@ -58,6 +105,24 @@ class SumavPostgresConnector:
         except (psycopg2.OperationalError, psycopg2.InterfaceError):
             self._conn = self._connect(**self._dbkwargs)
 
+    def _copy_rows(self, cur, table, columns, rows):
+        '''Stream rows to table by COPY FROM STDIN
+
+        :param cursor cur:
+        :param str table:
+        :param list columns:
+        :param iterable rows: Tuples of values. None is copied as NULL and
+            list as an array.
+        :return: Number of copied rows
+        :rtype: int
+        '''
+        reader = _CopyRowsReader(rows, table)
+        cur.copy_expert('COPY %s(%s) FROM STDIN' %
+                        (table, ','.join(['"%s"' % c for c in columns])),
+                        reader, size=1048576)
+        logger.info('%9s rows copied to %s.' % (reader.rowcount, table))
+        return reader.rowcount
+
     def _hex_to_bytes(self, hexstr):
         'Need to call it when use select statements'
         if hexstr is None:
@@ -110,11 +175,42 @@ class SumavPostgresConnector:
                 with open(here + 'schema.sql', 'r') as f:
                     sql = f.read().replace('sumav', self._dbkwargs['user'])
                     cur.execute(sql)
+                self.__migrate_tables(cur)
                 self._conn.commit()
                 logger.info('New tables created.')
                 return True
 
+            elif ('token_node' in [r[0] for r in cur.fetchall()] and
+                  self.__needs_migration(cur)):
+                try:
+                    self.__migrate_tables(cur)
+                    self._conn.commit()
+                    logger.info('Tables migrated.')
+                except psycopg2.errors.InsufficientPrivilege as e:
+                    # Read-only roles read graphs as they are
+                    self._conn.rollback()
+                    logger.warning('Tables are not migrated. %s' % e)
+
         return False
 
+    def __needs_migration(self, cur):
+        '''Return whether objects created by migration.sql are missing. It
+        only reads the catalog so that roles which cannot create tables can
+        connect to a migrated database.
+        '''
+        cur.execute("SELECT to_regclass('public.token_stat') IS NULL OR "
+                    "  to_regclass('public.graph_build_log') IS NULL OR "
+                    "  NOT EXISTS (SELECT 1 FROM information_schema.columns "
+                    "              WHERE table_schema='public' AND "
+                    "                    table_name='token_node' AND "
+                    "                    column_name='importance')")
+        return cur.fetchone()[0]
+
+    def __migrate_tables(self, cur):
+        'Create tables added after the initial schema if they do not exist'
+        here = os.path.abspath(os.path.dirname(__file__)) + '/'  # Script based
+        with open(here + 'migration.sql', 'r') as f:
+            cur.execute(f.read())
+
     def close(self):
         self._conn.close()
@@ -0,0 +1,138 @@
+'''
+asyncio searcher
+'''
+# Default packages
+import asyncio
+import logging
+import platform
+from concurrent.futures import ThreadPoolExecutor
+
+# 3rd-party packages
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+
+# Internal packages
+import sumav.conf as conf
+from sumav.graph.searcher import SumavGraphSearcher
+
+logger = logging.getLogger(__name__)
+
+
+class SumavGraphAsyncSearcher:
+    '''asyncio interface of SumavGraphSearcher
+
+    Tokens are scored in the event loop with the graph in memory, which does
+    not wait for RDB. Hashes are looked up in RDB by at most connections
+    threads sharing a pool of connections, so that any number of concurrent
+    requests neither block the event loop nor start a thread each.
+
+    >>> async with SumavGraphAsyncSearcher(**psql_conf) as searcher:
+    ...     await searcher.get_representative_token(sha256=sha256)
+    '''
+    def __init__(self, user, password, database, host, port,
+                 snapshot=conf.graph_snapshot,
+                 cache_size=conf.result_cache_size,
+                 cache_memory=conf.result_cache_memory,
+                 connections=conf.async_connections):
+        '''Load the graph. It blocks until the graph is loaded.
+
+        :param int connections: Number of connections and threads looking up
+            hashes in RDB
+        '''
+        self.searcher = SumavGraphSearcher(user, password, database, host,
+                                           port, snapshot=snapshot,
+                                           cache_size=cache_size,
+                                           cache_memory=cache_memory)
+        self.searcher.load_edges()  # Not to load them in the event loop
+
+        self.__pool = ThreadedConnectionPool(
+            1, connections, user=user, password=password, database=database,
+            host=host, port=port,
+            application_name='sumav@%s' % platform.node())
+        self.__executor = ThreadPoolExecutor(connections)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        # Queued lookups are waited for in a thread not to block the loop
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    def close(self):
+        '''Close connections after queued lookups are finished. It blocks, so
+        that coroutines should close it by async with.
+        '''
+        self.__executor.shutdown()
+        self.__pool.closeall()
+        self.searcher.close()
+
+    def watch_graph(self, interval=conf.graph_poll_interval):
+        '''Load graphs of new builds in a background thread. Refer to
+        SumavGraphSearcher.watch_graph().
+        '''
+        self.searcher.watch_graph(interval)
+
+    async def get_representative_token(self, av_labels=None, tokens=None,
+                                       sha256=None, md5=None, **kwargs):
+        '''Get a representative token. Refer to
+        SumavGraphSearcher.get_representative_token().
+
+        :param str sha256: Tokens of it are looked up in RDB
+        :param str md5: Tokens of it are looked up in RDB
+        '''
+        if tokens is None and av_labels is None:
+            if sha256 is not None:
+                tokens = (await self.__get_tokens([sha256], 'sha256'))[0]
+            elif md5 is not None:
+                tokens = (await self.__get_tokens([md5], 'md5'))[0]
+            if tokens is None:
+                return None
+
+        return self.searcher.get_representative_token(
+            av_labels=av_labels, tokens=tokens, **kwargs)
+
+    async def get_representative_tokens(self, av_labels_list=None,
+                                        tokens_list=None, sha256_list=None,
+                                        md5_list=None, **kwargs):
+        '''Get representative tokens of samples at once. Refer to
+        SumavGraphSearcher.get_representative_tokens().
+
+        :param list sha256_list: Tokens of them are looked up in RDB at once
+        :param list md5_list: Tokens of them are looked up in RDB at once
+        '''
+        if tokens_list is None and av_labels_list is None:
+            if sha256_list is not None:
+                tokens_list = await self.__get_tokens(sha256_list, 'sha256')
+            elif md5_list is not None:
+                tokens_list = await self.__get_tokens(md5_list, 'md5')
+            else:
+                return []
+
+        return self.searcher.get_representative_tokens(
+            av_labels_list=av_labels_list, tokens_list=tokens_list, **kwargs)
+
+    async def compare_tokens(self, token, token2, without_rowcount=False):
+        return self.searcher.compare_tokens(token, token2, without_rowcount)
+
+    async def get_related_tokens(self, token):
+        return self.searcher.get_related_tokens(token)
+
+    async def __get_tokens(self, hashes, column):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.__executor, self.__select_tokens, hashes, column)
+
+    def __select_tokens(self, hashes, column, retry=True):
+        'Look up tokens of hashes with a connection of the pool'
+        conn, broken = self.__pool.getconn(), False
+        try:
+            conn.autocommit = True
+            return self.searcher.get_tokens_of_hashes(hashes, column, conn)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True  # Connect again
+            if not retry:
+                raise
+        finally:
+            self.__pool.putconn(conn, close=broken)
+
+        return self.__select_tokens(hashes, column, retry=False)
@@ -2,22 +2,47 @@
 Builder
 '''
 # Default packages
+import os
 import time
+import pickle
+import shutil
 import logging
-from difflib import SequenceMatcher
+import tempfile
+import multiprocessing as mp
+from array import array
 
 # 3rd-party packages
+from psycopg2.errors import LockNotAvailable
 from psycopg2.extras import RealDictCursor
+try:
+    import numpy as np
+except ImportError:
+    np = None  # Probabilities are calculated in python loops
 
 # Internal packages
 import sumav.conf as conf
+import sumav.utils as utils
 from sumav.dbconnector import SumavPostgresConnector
+from sumav.graph.tokengraph import TokenGraph
+from sumav.graph.edgecounter import EdgeCounter
+from sumav.graph.disjointset import DisjointSet
+from sumav.graph.similarity import TokenSimilarity
+from sumav.graph.snapshot import GraphSnapshot
 
 logger = logging.getLogger(__name__)
 
 
 class SumavGraphBuilder(SumavPostgresConnector):
     __batch_size = 100000
+    __lock_timeout = '5s'  # Queries wait for a swap of tables up to it
+    __swap_retries = 60
+    __constraints = {
+        'token_stat': [('token_stat_pkey', 'PRIMARY KEY (token)')],
+        'token_node': [('token_node_pkey', 'PRIMARY KEY (id)'),
+                       ('token_node_token_ukey', 'UNIQUE (token)')],
+        'token_edge': [('token_edge_pkey', 'PRIMARY KEY (id)'),
+                       ('token_edge_token_token2_ukey',
+                        'UNIQUE (token, token2)')]}
 
     def __init__(self, user, password, database, host, port):
         '''Connect to SumavPostgresConnector RDB
@@ -35,225 +60,977 @@ class SumavGraphBuilder(SumavPostgresConnector):
         
         return {'edge_size': edge_size, 'node_size': node_size}
 
-    def build_graph(self):
+    def build_graph(self, incremental=False,
+                    processes=conf.worker_concurrency, mode='python',
+                    memory_limit=conf.build_memory_limit, single_pass=False,
+                    use_numpy=True, checkpoint=conf.build_checkpoint,
+                    dedup=False, snapshot=conf.graph_snapshot):
+        '''Build Sumav graph from the detection table
+
+        :param bool incremental: Scan only detection rows added after the last
+            build and add their counts to the existing graph. The whole graph
+            is built if there is no previous build.
+        :param int processes: Number of processes to count nodes and edges
+        :param str mode: 'python' counts nodes and edges in this machine and
+            'sql' counts them inside PostgreSQL with parallel workers. Both
+            build the same graph.
+        :param float memory_limit: Megabytes of edge counts kept in memory by
+            processes. Edge counts over the limit are spilled to temporary
+            files and merged. No limit if it is 0 or None.
+        :param bool single_pass: Count nodes and edges by scanning detections
+            once in python mode. Edges of every token are counted and those
+            of rare tokens are pruned after the scan, so that it takes more
+            memory than scanning twice.
+        :param bool use_numpy: Calculate probabilities and relations with
+            NumPy arrays if NumPy is installed.
+        :param str checkpoint: Path of a file saving the graph whenever a
+            step is finished. A build is resumed from the file if it is saved
+            by a build of the same database which was not finished.
+        :param bool dedup: Count detections having the same tokens once
+            weighted by the number of them in python mode.
+        :param str snapshot: Path of a snapshot file of the graph written
+            after the build for searchers
+        '''
+        if mode not in ('python', 'sql'):
+            raise ValueError('mode should be python or sql: %s' % mode)
         self._reconnect_if_closed()
         totalsec = 0
-        nodes, edges = {}, {}
-        with self._conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute('TRUNCATE TABLE token_edge,token_node')
+        use_numpy = use_numpy and np is not None
+        build_id, from_id = self.__get_last_build()
+        state = self.__load_checkpoint(checkpoint, build_id)
+        if state is not None:
+            step, graph = state['step'], state['graph']
+            incremental = state['incremental']
+            last_detection_id, changed = (state['last_detection_id'],
+                                          state['changed'])
+            logger.info('Resume the build after step %s from %s.' %
+                        (step, checkpoint))
+        else:
+            step, graph = 0, TokenGraph()
+            if not incremental or from_id is None:
+                if incremental:
+                    logger.info('No previous build found. Build whole graph.')
+                incremental, from_id = False, 0
+            else:
+                started = time.time()
+                logger.info('[Step 0/4] Load the graph built until detection '
+                            'id %s.' % from_id)
+                self.__load_graph(graph)
+                elapsed = time.time() - started
+                totalsec += elapsed
+                logger.info('%.2fs elapsed to load the graph..' % elapsed)
 
-        started = time.time()
-        logger.info('[Step 1/4] Build token graph.')
-        affected = self.__build_token_graph(nodes, edges)
-        elapsed = time.time() - started
-        totalsec += elapsed
-        logger.info('%.2fs elapsed to build token graph..' % elapsed)
-        if affected == 0:
-            logger.info('Total %.2fs elapsed.' % totalsec)
-            return
+        if step < 1:
+            started = time.time()
+            logger.info('[Step 1/4] Build token graph.')
+            affected = self.__build_token_graph(graph, from_id, processes,
+                                                mode, memory_limit,
+                                                single_pass, dedup)
+            elapsed = time.time() - started
+            totalsec += elapsed
+            logger.info('%.2fs elapsed to build token graph..' % elapsed)
+            if affected is None:
+                logger.info('Total %.2fs elapsed.' % totalsec)
+                return
+            last_detection_id, changed = affected
+            if not incremental:
+                changed = None  # Every node and edge is affected
+            self.__save_checkpoint(checkpoint, build_id, 1, graph,
+                                   incremental, last_detection_id, changed)
 
-        started = time.time()
-        logger.info('[Step 2/4] Calculate conditional probabilities of edges.')
-        self.__calculate_conditional_probabilities(nodes, edges)
-        elapsed = time.time() - started
-        totalsec += elapsed
-        logger.info('%.2fs elapsed to calcuate conditional probabilites '
-                    'between nodes..' % elapsed)
+        if step < 2:
+            started = time.time()
+            logger.info('[Step 2/4] Calculate conditional probabilities of '
+                        'edges.')
+            changed = self.__calculate_conditional_probabilities(
+                graph, changed, use_numpy)
+            elapsed = time.time() - started
+            totalsec += elapsed
+            logger.info('%.2fs elapsed to calcuate conditional probabilites '
+                        'between nodes..' % elapsed)
+            self.__save_checkpoint(checkpoint, build_id, 2, graph,
+                                   incremental, last_detection_id, changed)
 
-        started = time.time()
-        logger.info('[Step 3/4] Calculate relations between nodes.')
-        self.__calculate_relations(nodes, edges)
-        elapsed = time.time() - started
-        totalsec += elapsed
-        logger.info('%.2fs elapsed to calcaulate relations.' % elapsed)
+        if step < 3:
+            started = time.time()
+            logger.info('[Step 3/4] Calculate relations between nodes.')
+            self.__calculate_relations(graph, changed, processes, use_numpy)
+            elapsed = time.time() - started
+            totalsec += elapsed
+            logger.info('%.2fs elapsed to calcaulate relations.' % elapsed)
+            self.__save_checkpoint(checkpoint, build_id, 3, graph,
+                                   incremental, last_detection_id, changed)
 
         started = time.time()
         logger.info('[Step 4/4] Insert nodes and edges in RDB.')
-        self.__insert_nodes_and_edges(nodes, edges)
+        self.__insert_nodes_and_edges(graph)
+        self._conn.commit()
+
+        def swap(cur):
+            for table in self.__constraints:
+                cur.execute('DROP TABLE IF EXISTS %s_old' % table)
+                self.__rename_table(cur, table, table + '_old')
+                self.__rename_table(cur, table + '_new', table)
+                self.__move_sequences(cur, table + '_old', table)
+            cur.execute('INSERT INTO graph_build_log(last_detection_id,'
+                        'incremental,"timestamp") VALUES (%s,%s,now())',
+                        [last_detection_id, incremental])
+        self.__swap_tables(swap)
         elapsed = time.time() - started
         totalsec += elapsed
         logger.info('%.2fs elapsed to insert nodes and edges..' % elapsed)
 
-        self._conn.commit()
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+
+        if snapshot:
+            started = time.time()
+            self.write_snapshot(snapshot)
+            elapsed = time.time() - started
+            totalsec += elapsed
+            logger.info('%.2fs elapsed to write the snapshot.' % elapsed)
+        self.__notify_graph()
         logger.info('Total %.2fs elapsed.' % totalsec)
 
-    def __build_token_graph(self, nodes, edges, min_token_len=4):
-        node_max_id = self.__get_max_id(nodes)
-        edge_max_id = self.__get_max_id(edges)
+    def write_snapshot(self, path):
+        '''Write a snapshot of the graph in RDB which searchers map in memory
+
+        :param str path:
+        '''
+        self._reconnect_if_closed()
+        build_id, _ = self.__get_last_build()
+
+        def nodes():
+            with self._conn.cursor('srvcur') as cur:
+                cur.itersize = self.__batch_size
+                # Graphs built before the columns are added have nulls
+                cur.execute('SELECT id,token,alias,parents,token_count,'
+                            'row_count,token_ratio,num_subsets,'
+                            'coalesce(importance,'
+                            '         token_count::float8/row_count),'
+                            'coalesce(generality,num_subsets::float8/'
+                            '         (SELECT count(*) FROM token_node)) '
+                            'FROM token_node ORDER BY token COLLATE "C"')
+                yield from cur
+
+        def edges():
+            with self._conn.cursor('srvcur') as cur:
+                cur.itersize = self.__batch_size
+                cur.execute(GraphSnapshot.edge_sql)
+                yield from cur
+
+        GraphSnapshot.write(path, nodes(), edges(), build_id)
+        self._conn.commit()
+
+    def rollback_graph(self, snapshot=conf.graph_snapshot):
+        '''Restore the graph of the previous build
+
+        The graph tables replaced by the last build are kept as token_*_old
+        tables until the next build. They are renamed back and the last build
+        is removed from graph_build_log so that an incremental build starts
+        from the previous build.
+
+        :param str snapshot: Path to write a snapshot of the restored graph
+        '''
+        self._reconnect_if_closed()
+        with self._conn.cursor() as cur:
+            for table in self.__constraints:
+                cur.execute('SELECT to_regclass(%s)', [table + '_old'])
+                if cur.fetchone()[0] is None:
+                    raise Exception('No previous graph to roll back: %s_old'
+                                    % table)
+
+        def swap(cur):
+            for table in self.__constraints:
+                self.__move_sequences(cur, table, table + '_old')
+                cur.execute('DROP TABLE %s' % table)
+                self.__rename_table(cur, table + '_old', table)
+            cur.execute('DELETE FROM graph_build_log WHERE id='
+                        '(SELECT max(id) FROM graph_build_log)')
+        self.__swap_tables(swap)
+        logger.info('The graph is rolled back to the previous build.')
+
+        if snapshot:
+            self.write_snapshot(snapshot)
+        self.__notify_graph()
+
+    def __notify_graph(self):
+        'Notify searchers watching builds that the graph is replaced'
+        build_id, _ = self.__get_last_build()
+        with self._conn.cursor() as cur:
+            cur.execute('SELECT pg_notify(%s,%s)',
+                        [conf.graph_channel, str(build_id)])
+        self._conn.commit()
+
+    def __swap_tables(self, swap):
+        '''Run swap(cur) renaming tables in a short transaction
+
+        Renaming waits for queries reading the tables, and queries arriving
+        after it wait for renaming. Renaming is given up after lock_timeout
+        and tried again so that queries are not blocked for long.
+        '''
+        for retry in range(self.__swap_retries):
+            try:
+                with self._conn.cursor() as cur:
+                    cur.execute("SET LOCAL lock_timeout='%s'" %
+                                self.__lock_timeout)
+                    swap(cur)
+                self._conn.commit()
+                return
+            except LockNotAvailable:
+                self._conn.rollback()
+                logger.info('Graph tables are in use. Retry to swap them. '
+                            '(%s/%s)' % (retry + 1, self.__swap_retries))
+                time.sleep(1)
+
+        raise Exception('Graph tables could not be swapped due to locks.')
+
+    def __rename_table(self, cur, table, new_table):
+        '''Rename table and constraints prefixed with the name of table'''
+        cur.execute('ALTER TABLE %s RENAME TO %s' % (table, new_table))
+        cur.execute('SELECT conname FROM pg_constraint '
+                    'WHERE conrelid=%s::regclass', [new_table])
+        for name, in cur.fetchall():
+            if name.startswith(table + '_'):
+                cur.execute('ALTER TABLE %s RENAME CONSTRAINT %s TO %s' %
+                            (new_table, name,
+                             new_table + name[len(table):]))
+
+    def __move_sequences(self, cur, table, new_table):
+        'Make sequences owned by columns of table owned by new_table'
+        cur.execute('SELECT s.relname,a.attname FROM pg_depend d '
+                    'JOIN pg_class s ON s.oid=d.objid '
+                    'JOIN pg_attribute a ON a.attrelid=d.refobjid AND '
+                    'a.attnum=d.refobjsubid '
+                    "WHERE s.relkind='S' AND d.deptype='a' AND "
+                    'd.refobjid=%s::regclass', [table])
+        for seq, column in cur.fetchall():
+            cur.execute('ALTER SEQUENCE %s OWNED BY %s.%s' %
+                        (seq, new_table, column))
+
+    def __get_last_build(self):
+        '''Return the id and the last detection id of the last build
+
+        :return: Nones if there is no previous build
+        :rtype: tuple
+        '''
+        with self._conn.cursor() as cur:
+            cur.execute('SELECT id,last_detection_id FROM graph_build_log '
+                        'ORDER BY id DESC LIMIT 1')
+            row = cur.fetchone()
+
+        return (None, None) if row is None else row
+
+    def __checkpoint_database(self):
+        return {k: self._dbkwargs[k] for k in ('host', 'port', 'database')}
+
+    def __save_checkpoint(self, path, build_id, step, graph, incremental,
+                          last_detection_id, changed):
+        if not path:
+            return
+
+        started = time.time()
+        state = {'database': self.__checkpoint_database(),
+                 'build_id': build_id, 'step': step, 'graph': graph,
+                 'incremental': incremental,
+                 'last_detection_id': last_detection_id, 'changed': changed}
+        # A crash while writing must not break the previous checkpoint
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+        logger.info('Step %s is saved to %s in %.2fs.' %
+                    (step, path, time.time() - started))
+
+    def __load_checkpoint(self, path, build_id):
+        '''Load a checkpoint saved after the last build of this database
+
+        :return: None if there is no checkpoint to resume
+        :rtype: dict
+        '''
+        if not path or not os.path.exists(path):
+            return None
 
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+        if (state['database'] != self.__checkpoint_database() or
+                state['build_id'] != build_id):
+            logger.info('Ignore %s saved by another build.' % path)
+            return None
+
+        return state
+
+    def __load_graph(self, graph):
+        with self._conn.cursor('srvcur') as cur:
+            cur.itersize = self.__batch_size
+            cur.execute('SELECT token,token_count,row_count FROM token_stat')
+            for tkn, tkn_cnt, row_cnt in cur:
+                graph.add_token_counts([tkn], [tkn_cnt], [row_cnt])
+
+        with self._conn.cursor('srvcur') as cur:
+            cur.itersize = self.__batch_size
+            cur.execute('SELECT id,token,alias,parents,token_ratio,'
+                        'num_subsets FROM token_node ORDER BY id')
+            for node_id, tkn, alias, parents, tkn_ratio, num_subsets in cur:
+                idx = graph.intern(tkn)
+                graph.add_node(idx, node_id)
+                graph.token_ratio[idx] = tkn_ratio
+                graph.num_subsets[idx] = num_subsets
+                if alias != 'None':
+                    graph.alias[idx] = graph.intern(alias)
+                if parents:
+                    graph.parents[idx] = [graph.intern(t) for t in parents]
+
+        with self._conn.cursor('srvcur') as cur:
+            cur.itersize = self.__batch_size
+            cur.execute('SELECT id,token,token2,"p(token2|token)",'
+                        '"p(token|token2)",intersection_row_count '
+                        'FROM token_edge ORDER BY id')
+            for edge_id, tkn, tkn2, p_token2, p_token, cnt in cur:
+                key = graph.pair(graph.intern(tkn), graph.intern(tkn2))
+                graph.add_edge(key, cnt, edge_id, p_token2, p_token)
+
+        logger.info('%s tokens, %s nodes and %s edges are loaded.' %
+                    (len(graph.tokens), len(graph.node_indexes()),
+                     len(graph.edge_key)))
+
+    def __build_token_graph(self, graph, from_id=0, processes=1,
+                            mode='python', memory_limit=None,
+                            single_pass=False, dedup=False, min_token_len=4):
+        '''Add counts of detection rows after from_id to the graph
+
+        :param int processes: Number of processes counting id range shards,
+            or parallel workers of PostgreSQL in sql mode
+        :param str mode: python or sql
+        :param float memory_limit: Megabytes of edge counts in memory
+        :param bool single_pass: Count nodes and edges in a scan
+        :param bool dedup: Count the same tokens of detections at once
+        :return: last detection id and indexes of tokens whose counts are
+            changed
+        :rtype: tuple
+        '''
         with self._conn.cursor() as cur:
-            cur.execute('SELECT count(*) FROM detection')
-            len_detections = cur.fetchone()[0]
+            cur.execute('SELECT count(*),min(id),max(id) FROM detection '
+                        'WHERE id>%s', [from_id])
+            len_detections, first_id, last_detection_id = cur.fetchone()
             if len_detections == 0:
-                logger.info('No rows in the detection table.')
-                return 0
+                logger.info('No new rows in the detection table.')
+                return None
+
+        where = 'd.id>%s AND d.id<=%s'
+        if mode == 'sql':
+            id_ranges = [[from_id, last_detection_id]]
+            with self._conn.cursor() as cur:
+                cur.execute('SET LOCAL max_parallel_workers_per_gather=%s',
+                            [max(0, processes - 1)])
+        else:
+            # Split detections into id ranges counted by each process
+            processes = max(1, min(processes, len_detections))
+            step = -(-(last_detection_id - first_id + 1) // processes)
+            id_ranges = [[lo, min(lo + step, last_detection_id)] for lo in
+                         range(first_id - 1, last_detection_id, step)]
+            logger.info('%s detections are split into %s shards.' %
+                        (len_detections, len(id_ranges)))
+
+        if single_pass and (mode == 'sql' or memory_limit):
+            logger.info('Count nodes and edges in separate scans because '
+                        'single pass is not supported with sql mode or a '
+                        'memory limit.')
+            single_pass = False
+        if dedup and mode == 'sql':
+            logger.info('Detections are not deduplicated in sql mode.')
+            dedup = False
 
         logger.info('Start building nodes of the graph.')
-        with self._conn.cursor('srvcur', cursor_factory=RealDictCursor) as cur:
-            # Increment count values of nodes and edges of token graph
-            cur.itersize = self.__batch_size
-            cur.execute('SELECT * FROM detection ORDER BY id')
-            for i, detection in enumerate(cur, 1):
-                last_detection_id = detection['id']
-                if i % self.__batch_size == 0:
-                    logger.info('%9d/%s detection processed. '
-                                '([count] node: %s, edge :%s)' %
-                                (i, len_detections, len(nodes), len(edges)))
-
-                if detection['tokens'] is None:
+        changed, shard_edges = set(), []
+        if single_pass:
+            for tokens, tkn_cnts, row_cnts, keys, counts in self.__count(
+                    mode, 'graph', where, id_ranges, dedup, min_token_len):
+                idxs = graph.add_token_counts(tokens, tkn_cnts, row_cnts)
+                changed.update(idxs)
+                shard_edges.append((idxs, keys, counts))
+        else:
+            for shard_counts in self.__count(mode, 'nodes', where, id_ranges,
+                                             dedup, min_token_len):
+                changed.update(graph.add_token_counts(*shard_counts))
+        logger.info('%s tokens are counted.' % len(graph.tokens))
+
+        # Remove rare tokens or not widely used tokens
+        total_tkn_cnt = len(graph.tokens)
+        added, removed = set(), set()
+        for idx in range(total_tkn_cnt):
+            tkn_cnt, row_cnt = graph.token_count[idx], graph.row_count[idx]
+            if (tkn_cnt / total_tkn_cnt < 0.0000001 or
+                    tkn_cnt / row_cnt == 1):
+                if graph.node_id[idx]:
+                    graph.remove_node(idx)
+                    removed.add(idx)
+            elif not graph.node_id[idx]:
+                # Ids of a whole build follow the order tokens appear first
+                graph.add_node(idx, None if from_id else idx + 1)
+                added.add(idx)
+        node_index = graph.node_index()
+        logger.info('%s rare nodes are removed.' %
+                    (total_tkn_cnt - len(node_index)))
+
+        # Remove edges of nodes which became rare
+        if removed:
+            changed |= graph.remove_edges(removed)
+            changed -= removed
+
+        scans = [] if single_pass else [(where, id_ranges, None)]
+        if from_id > 0 and added:
+            # Rows scanned by previous builds have edges of the added nodes
+            scans.append(('d.id<=%s AND d.unique_tokens && %s::varchar[]',
+                          [[from_id, sorted(graph.tokens[i] for i in added)]],
+                          added))
+
+        max_edges, tmpdir = None, None
+        if memory_limit and mode == 'python':
+            # PostgreSQL spills its aggregation by itself in sql mode
+            max_edges = max(1, int(memory_limit * 2 ** 20 /
+                                   EdgeCounter.bytes_per_edge / len(id_ranges)))
+            tmpdir = tempfile.mkdtemp(prefix='sumav_')
+            logger.info('Edge counts over %s edges per process are spilled to '
+                        '%s.' % (max_edges, tmpdir))
+
+        logger.info('Start building edges of the graph.')
+        while shard_edges:
+            # Edges of a shard are keyed by token indexes of the shard
+            idxs, keys, counts = shard_edges.pop(0)
+            node_keys, node_counts = array('Q'), array('q')
+            for key, cnt in zip(keys, counts):
+                idx, idx2 = idxs[key >> 32], idxs[key & 0xffffffff]
+                if graph.node_id[idx] and graph.node_id[idx2]:
+                    node_keys.append(graph.pair(idx, idx2))
+                    node_counts.append(cnt)
+            graph.add_edge_counts(node_keys, node_counts)
+        try:
+            for where, vals_list, required in scans:
+                runs = []
+                for keys, counts, shard_runs in self.__count(
+                        mode, 'edges', where, vals_list, dedup, node_index,
+                        required, max_edges, tmpdir):
+                    graph.add_edge_counts(keys, counts)
+                    runs.extend(shard_runs)
+                if runs:
+                    unique = len(graph.edge_key) == 0
+                    for keys, counts in EdgeCounter.merge_runs(runs, max_edges,
+                                                               tmpdir):
+                        graph.add_edge_counts(keys, counts, unique)
+        finally:
+            if tmpdir is not None:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+        logger.info('%s nodes and %s edges are counted.' %
+                    (len(node_index), len(graph.edge_key)))
+
+        return last_detection_id, changed
+
+    def __count(self, mode, target, where, vals_list, dedup, *args):
+        '''Yield counts of nodes or edges of detections matched with where
+
+        Counts are yielded in the order that nodes or edges appear first.
+
+        :param bool dedup: Group detections by tokens to count, or by
+            unique_tokens to count edges. Groups are ordered by the first
+            detection of them so that nodes and edges appear in the same
+            order as counting every detection.
+        '''
+        if mode == 'sql':
+            target = {'nodes': self.__count_nodes_sql,
+                      'edges': self.__count_edges_sql}[target]
+            for vals in vals_list:
+                yield from target(where, vals, *args)
+            return
+
+        if not dedup:
+            sql = ('SELECT id,tokens,unique_tokens,1 AS multiplicity '
+                   'FROM detection d WHERE %s ORDER BY id' % where)
+        elif target == 'edges':
+            # tokens of edges are only tested whether they are NULL
+            sql = ('SELECT min(id) AS id,unique_tokens AS tokens,'
+                   'unique_tokens,count(*) AS multiplicity FROM detection d '
+                   'WHERE %s AND d.tokens IS NOT NULL '
+                   'GROUP BY unique_tokens ORDER BY 1' % where)
+        else:
+            sql = ('SELECT min(id) AS id,tokens,'
+                   'min(unique_tokens) AS unique_tokens,'
+                   'count(*) AS multiplicity FROM detection d '
+                   'WHERE %s AND d.tokens IS NOT NULL '
+                   'GROUP BY tokens ORDER BY 1' % where)
+        target = {'nodes': self.__count_nodes,
+                  'edges': self.__count_edges,
+                  'graph': self.__count_graph}[target]
+        yield from self.__run_shards(target, sql, vals_list, *args)
+
+    def __run_shards(self, target, sql, vals_list, *args):
+        '''Run target with a cursor of each vals in vals_list
+
+        Shards are counted by child processes if there are more than one, and
+        their results are yielded in the order of vals_list so that ids of
+        nodes and edges are the same as counting them in a process. Children
+        are forked whatever the default start method is, because the builder
+        having a connection cannot be pickled to spawn them.
+        '''
+        if len(vals_list) == 1:
+            with self._conn.cursor('srvcur',
+                                   cursor_factory=RealDictCursor) as cur:
+                cur.itersize = self.__batch_size
+                cur.execute(sql, vals_list[0])
+                yield target(cur, 0, *args)
+            return
+
+        ctx = mp.get_context('fork')
+        outque = ctx.Queue()
+        prs = [ctx.Process(target=self.__shard_worker,
+                           args=(outque, shard, target, sql, vals) + args)
+               for shard, vals in enumerate(vals_list)]
+        for pr in prs:
+            pr.start()
+
+        try:
+            results, next_shard = {}, 0
+            while next_shard < len(vals_list):
+                # Fail if a process of a shard not counted yet is killed
+                shard, result, err = utils.get_from_processes(
+                    outque, [pr for i, pr in enumerate(prs)
+                             if i >= next_shard and i not in results])
+                if err is not None:
+                    raise Exception('Shard %s failed: %s' % (shard, err))
+
+                results[shard] = result
+                while next_shard in results:
+                    yield results.pop(next_shard)
+                    next_shard += 1
+        finally:
+            for pr in prs:
+                if next_shard < len(vals_list):
+                    pr.terminate()
+                pr.join()
+
+    def __shard_worker(self, outque, shard, target, sql, vals, *args):
+        # Connection of the parent process must not be shared
+        conn = self._connect(**self._dbkwargs)
+        try:
+            with conn.cursor('srvcur', cursor_factory=RealDictCursor) as cur:
+                cur.itersize = self.__batch_size
+                cur.execute(sql, vals)
+                outque.put((shard, target(cur, shard, *args), None))
+        except Exception as e:
+            logger.exception(e)
+            outque.put((shard, None, str(e)))
+        finally:
+            conn.close()
+
+    def __count_nodes(self, cur, shard, min_token_len):
+        '''Count tokens of detections
+
+        :return: tokens, token counts and row counts in the order that tokens
+            appear first
+        :rtype: tuple
+        '''
+        index, tokens = {}, []
+        tkn_cnts, row_cnts = array('q'), array('q')
+        i = 0
+        for i, detection in enumerate(cur, 1):
+            if i % self.__batch_size == 0:
+                logger.info('%9d detection processed by %s. ([count] token: '
+                            '%s)' % (i, mp.current_process().name,
+                                     len(tokens)))
+
+            if detection['tokens'] is None:
+                continue
+
+            # Update token count on token_node table
+            tkn_cnt = {}
+            for tkn in detection['tokens']:
+                if len(tkn) < min_token_len:
                     continue
 
-                # Update token count on token_node table
-                tkn_cnt = {}
-                for tkn in detection['tokens']:
-                    if len(tkn) < min_token_len:
-                        continue
+                if tkn in tkn_cnt:
+                    tkn_cnt[tkn] += 1
+                else:
+                    tkn_cnt[tkn] = 1
+
+            mul = detection['multiplicity']
+            for tkn, cnt in tkn_cnt.items():
+                idx = index.get(tkn)
+                if idx is None:
+                    index[tkn] = len(tokens)
+                    tokens.append(tkn)
+                    tkn_cnts.append(cnt * mul)
+                    row_cnts.append(mul)
+                else:
+                    tkn_cnts[idx] += cnt * mul
+                    row_cnts[idx] += mul
 
-                    if tkn in tkn_cnt:
-                        tkn_cnt[tkn] += 1
+        logger.info('%9d detection processed by %s. ([count] token: %s)' %
+                    (i, mp.current_process().name, len(tokens)))
+        return tokens, tkn_cnts, row_cnts
+
+    def __count_edges(self, cur, shard, node_index, required=None,
+                      max_edges=None, tmpdir=None):
+        '''Count co-occurrences of nodes in detections
+
+        :param int shard: Order of the id range shard
+        :param dict node_index: Indexes of tokens of nodes
+        :param set required: If it is given, only edges having one of these
+            indexes are counted.
+        :param int max_edges: Edge counts in memory. Counts over it are
+            spilled to run files in tmpdir.
+        :return: packed keys and counts of edges in the order that edges
+            appear first, and run files having the rest of edges
+        :rtype: tuple
+        '''
+        counter = EdgeCounter(max_edges, tmpdir, shard)
+        edge_cnt = counter.counts
+        i = 0
+        for i, detection in enumerate(cur, 1):
+            if i % self.__batch_size == 0:
+                logger.info('%9d detection processed by %s. ([count] edge: '
+                            '%s)' % (i, mp.current_process().name,
+                                     len(edge_cnt)))
+
+            if detection['tokens'] is None:
+                continue
+
+            # Indexes of nodes in lexicographical order of tokens
+            mul = detection['multiplicity']
+            idxs = [node_index[tkn] for tkn in
+                    sorted(detection['unique_tokens']) if tkn in node_index]
+            for j, idx in enumerate(idxs):
+                for idx2 in idxs[j + 1:]:
+                    if (required is not None and idx not in required and
+                            idx2 not in required):
+                        continue  # Already counted by previous builds
+
+                    key = idx << 32 | idx2
+                    if key in edge_cnt:
+                        edge_cnt[key] += mul
                     else:
-                        tkn_cnt[tkn] = 1
+                        edge_cnt[key] = mul
+            counter.spill_if_full()
+
+        logger.info('%9d detection processed by %s. ([count] edge: %s, '
+                    'spilled runs: %s)' % (i, mp.current_process().name,
+                                           len(edge_cnt), len(counter.runs)))
+        return counter.result()
 
-                for tkn, cnt in tkn_cnt.items():
-                    if tkn in nodes:
-                        nodes[tkn]['token_count'] += cnt
-                        nodes[tkn]['row_count'] += 1
+    def __count_graph(self, cur, shard, min_token_len):
+        '''Count tokens and co-occurrences of every token in detections
+
+        :return: tokens, token counts, row counts, and packed keys of indexes
+            of the tokens and counts of edges in the order that they appear
+            first
+        :rtype: tuple
+        '''
+        index, tokens = {}, []
+        tkn_cnts, row_cnts = array('q'), array('q')
+        edge_cnt = {}
+        i = 0
+        for i, detection in enumerate(cur, 1):
+            if i % self.__batch_size == 0:
+                logger.info('%9d detection processed by %s. ([count] token: '
+                            '%s, edge: %s)' % (i, mp.current_process().name,
+                                               len(tokens), len(edge_cnt)))
+            if detection['tokens'] is None:
+                continue
+
+            tkn_cnt = {}
+            for tkn in detection['tokens']:
+                if len(tkn) < min_token_len:
+                    continue
+
+                if tkn in tkn_cnt:
+                    tkn_cnt[tkn] += 1
+                else:
+                    tkn_cnt[tkn] = 1
+
+            mul = detection['multiplicity']
+            for tkn, cnt in tkn_cnt.items():
+                idx = index.get(tkn)
+                if idx is None:
+                    index[tkn] = len(tokens)
+                    tokens.append(tkn)
+                    tkn_cnts.append(cnt * mul)
+                    row_cnts.append(mul)
+                else:
+                    tkn_cnts[idx] += cnt * mul
+                    row_cnts[idx] += mul
+
+            # Rare tokens are not known yet, so every counted token is paired
+            idxs = [index[tkn] for tkn in sorted(detection['unique_tokens'])
+                    if tkn in tkn_cnt]
+            for j, idx in enumerate(idxs):
+                for idx2 in idxs[j + 1:]:
+                    key = idx << 32 | idx2
+                    if key in edge_cnt:
+                        edge_cnt[key] += mul
                     else:
-                        node_max_id += 1
-                        nodes[tkn] = {'id': node_max_id, 'token': tkn,
-                                      'alias': None, 'parents': [],
-                                      'token_count': cnt,
-                                      'row_count': 1, 'token_ratio': None,
-                                      'num_subsets': None}
-
-            logger.info('%9d/%s detection processed. '
-                        '([count] node: %s, edge :%s)' %
-                        (i, len_detections, len(nodes), len(edges)))
-
-            # Remove rare tokens or not widely used tokens
-            total_tkn_cnt = len(nodes)
-            removed_cnt = 0
-            for val in list(nodes.values()):
-                if (val['token_count'] / total_tkn_cnt < 0.0000001 or
-                        val['token_count'] / val['row_count'] == 1):
-                    del nodes[val['token']]
-                    removed_cnt += 1
-            logger.info('%s rare nodes are removed.' % removed_cnt)
+                        edge_cnt[key] = mul
 
-        logger.info('Start building edges of the graph.')
-        with self._conn.cursor('srvcur', cursor_factory=RealDictCursor) as cur:
-            # Update edge count on token_edge table
+        logger.info('%9d detection processed by %s. ([count] token: %s, '
+                    'edge: %s)' % (i, mp.current_process().name, len(tokens),
+                                   len(edge_cnt)))
+        return (tokens, tkn_cnts, row_cnts, array('Q', edge_cnt.keys()),
+                array('q', edge_cnt.values()))
+
+    def __count_nodes_sql(self, where, vals, min_token_len):
+        '''Count tokens of detections inside PostgreSQL
+
+        :return: chunks of tokens, token counts and row counts in the order
+            that tokens appear first
+        :rtype: generator
+        '''
+        # Parallel workers are not used for cursors but for CREATE TABLE AS
+        with self._conn.cursor() as cur:
+            cur.execute(
+                'CREATE UNLOGGED TABLE token_build_stat AS '
+                'SELECT token,sum(cnt)::bigint AS token_count,'
+                'count(*) AS row_count,min(pos) AS pos FROM ('
+                '  SELECT t.token,count(*) AS cnt,min(ARRAY[d.id,t.ord]) AS pos'
+                '  FROM detection d CROSS JOIN LATERAL unnest(d.tokens) '
+                '  WITH ORDINALITY AS t(token,ord) '
+                '  WHERE ' + where + ' AND length(t.token)>=%s '
+                '  GROUP BY d.id,t.token) AS r '
+                'GROUP BY token', vals + [min_token_len])
+            logger.info('%s tokens are counted by PostgreSQL.' % cur.rowcount)
+
+        with self._conn.cursor('srvcur') as cur:
             cur.itersize = self.__batch_size
-            cur.execute('SELECT * FROM detection WHERE id<=%s ORDER BY id' %
-                        last_detection_id)
-            for i, detection in enumerate(cur, 1):
-                if i % self.__batch_size == 0:
-                    logger.info('%9d/%s detection processed. '
-                                '([count] node: %s, edge :%s)' %
-                                (i, len_detections, len(nodes), len(edges)))
-
-                if detection['tokens'] is None:
-                    continue
+            cur.execute('SELECT token,token_count,row_count '
+                        'FROM token_build_stat ORDER BY pos')
+            while True:
+                rows = cur.fetchmany(self.__batch_size)
+                if not rows:
+                    break
+                yield ([r[0] for r in rows], array('q', [r[1] for r in rows]),
+                       array('q', [r[2] for r in rows]))
+
+        with self._conn.cursor() as cur:
+            cur.execute('DROP TABLE token_build_stat')
+
+    def __count_edges_sql(self, where, vals, node_index, required=None,
+                          *args):
+        '''Count co-occurrences of nodes in detections inside PostgreSQL
+
+        :return: chunks of packed keys and counts of edges in the order that
+            edges appear first, and empty run files
+        :rtype: generator
+        '''
+        with self._conn.cursor() as cur:
+            cur.execute('CREATE UNLOGGED TABLE token_build_node ('
+                        'token character varying(100) PRIMARY KEY,'
+                        'idx bigint NOT NULL,required boolean NOT NULL)')
+            self._copy_rows(cur, 'token_build_node',
+                            ['token', 'idx', 'required'],
+                            ((tkn, idx, required is None or idx in required)
+                             for tkn, idx in node_index.items()))
+            cur.execute('ANALYZE token_build_node')
+
+            # Edges are ordered as token < token2 by the byte order
+            cur.execute(
+                'CREATE UNLOGGED TABLE token_build_edge AS '
+                'SELECT a.idx,b.idx AS idx2,count(*) AS cnt,'
+                'min(d.id) AS first_id,a.token,b.token AS token2 '
+                'FROM detection d '
+                'CROSS JOIN LATERAL unnest(d.unique_tokens) AS t(token) '
+                'JOIN token_build_node a ON a.token=t.token '
+                'CROSS JOIN LATERAL unnest(d.unique_tokens) AS t2(token) '
+                'JOIN token_build_node b ON b.token=t2.token '
+                'WHERE ' + where + ' AND d.tokens IS NOT NULL AND '
+                't.token<t2.token COLLATE "C" AND (a.required OR b.required) '
+                'GROUP BY a.idx,b.idx,a.token,b.token', vals)
+            logger.info('%s edges are counted by PostgreSQL.' % cur.rowcount)
+
+        with self._conn.cursor('srvcur') as cur:
+            cur.itersize = self.__batch_size
+            cur.execute('SELECT idx,idx2,cnt FROM token_build_edge ORDER BY '
+                        'first_id,token COLLATE "C",token2 COLLATE "C"')
+            while True:
+                rows = cur.fetchmany(self.__batch_size)
+                if not rows:
+                    break
+                yield (array('Q', [r[0] << 32 | r[1] for r in rows]),
+                       array('q', [r[2] for r in rows]), [])
+
+        with self._conn.cursor() as cur:
+            cur.execute('DROP TABLE token_build_edge,token_build_node')
+
+    def __calculate_conditional_probabilities(self, graph, changed=None,
+                                              use_numpy=False):
+        '''Calculate probabilities of edges related to changed nodes
+
+        :param set changed: Indexes of tokens whose counts are changed. All
+            edges are calculated if it is None.
+        :param bool use_numpy: Calculate them with NumPy arrays
+        :return: indexes of tokens whose relations should be calculated again
+        :rtype: set
+        '''
+        if use_numpy:
+            return self.__calculate_conditional_probabilities_numpy(graph,
+                                                                    changed)
 
-                for j, tkn in enumerate(detection['unique_tokens']):
-                    if tkn not in nodes:
-                        continue
-
-                    for tkn2 in detection['unique_tokens'][j + 1:]:
-                        if tkn2 not in nodes:
-                            continue
-
-                        min_tkn, max_tkn = min(tkn, tkn2), max(tkn, tkn2)
-                        key = '%s_%s' % (min_tkn, max_tkn)
-                        if key in edges:
-                            edges[key]['intersection_row_count'] += 1
-                        else:
-                            edge_max_id += 1
-                            edges[key] = {
-                                'id': edge_max_id, 'token': min_tkn,
-                                'token2': max_tkn, 'p(token2|token)': None,
-                                'p(token|token2)': None,
-                                'intersection_row_count': 1}\
-
-            logger.info('%9d/%s detection processed. '
-                        '([count] node: %s, edge :%s)' %
-                        (i, len_detections, len(nodes), len(edges)))
-
-        return i
-
-    def __calculate_conditional_probabilities(self, nodes, edges):
         # Update conditional probabilities in token edges
-        for i, edge in enumerate(edges.values(), 1):
-            if i % self.__batch_size == 0:
-                logger.info('%9s/%s token_edge processed.' % (i, len(edges)))
+        affected = set() if changed is not None else None
+        row_count, edge_count = graph.row_count, graph.edge_count
+        len_edges = len(graph.edge_key)
+        for pos, key in enumerate(graph.edge_key):
+            if pos and pos % self.__batch_size == 0:
+                logger.info('%9s/%s token_edge processed.' % (pos, len_edges))
 
-            try:
-                edge['p(token2|token)'] = (edge['intersection_row_count'] /
-                                           nodes[edge['token']]['row_count'])
-                edge['p(token|token2)'] = (edge['intersection_row_count'] /
-                                           nodes[edge['token2']]['row_count'])
-            except Exception as e:
-                logger.error(str(e))
+            idx, idx2 = graph.unpair(key)
+            if changed is not None:
+                if idx not in changed and idx2 not in changed:
+                    continue
+                affected.add(idx)
+                affected.add(idx2)
+
+            graph.p_token2[pos] = edge_count[pos] / row_count[idx]
+            graph.p_token[pos] = edge_count[pos] / row_count[idx2]
 
         # Update token_ratio in token nodes
-        total = sum([n['token_count'] for n in nodes.values()])
-        for i, node in enumerate(nodes.values(), 1):
-            if i % self.__batch_size == 0:
-                logger.info('%9s/%s token_node processed.' % (i, len(edges)))
+        node_idxs = graph.node_indexes()
+        total = sum([graph.token_count[idx] for idx in node_idxs])
+        for idx in node_idxs:
+            graph.token_ratio[idx] = graph.token_count[idx] / total
 
-            node['token_ratio'] = node['token_count'] / total
-            node['num_subsets'] = 0  # Will be updated below
+        if affected is not None:
+            affected |= changed
 
-    def __calculate_relations(self, nodes, edges):
-        alias_graph = {k: None for k in nodes.keys()}
-        for i, edge in enumerate(edges.values(), 1):
-            if i % self.__batch_size == 0:
-                logger.info('%9s/%s relation calculated.' % (i, len(edges)))
+        return affected
+
+    def __calculate_conditional_probabilities_numpy(self, graph, changed=None):
+        # Arrays share memory of the graph. They are released before
+        # returning so that the graph can be resized again.
+        keys = np.frombuffer(graph.edge_key, dtype=np.uint64)
+        idx = (keys >> np.uint64(32)).astype(np.int64)
+        idx2 = (keys & np.uint64(0xffffffff)).astype(np.int64)
+        if changed is None:
+            mask = slice(None)
+        else:
+            changed_idxs = np.fromiter(changed, dtype=np.int64,
+                                       count=len(changed))
+            mask = np.isin(idx, changed_idxs) | np.isin(idx2, changed_idxs)
+            idx, idx2 = idx[mask], idx2[mask]
+
+        # Update conditional probabilities in token edges
+        row_count = np.frombuffer(graph.row_count, dtype=np.int64)
+        edge_count = np.frombuffer(graph.edge_count, dtype=np.int64)[mask]
+        np.frombuffer(graph.p_token2)[mask] = edge_count / row_count[idx]
+        np.frombuffer(graph.p_token)[mask] = edge_count / row_count[idx2]
+
+        # Update token_ratio in token nodes
+        node_idxs = np.flatnonzero(np.frombuffer(graph.node_id,
+                                                 dtype=np.int64))
+        token_count = np.frombuffer(graph.token_count, dtype=np.int64)
+        total = int(token_count[node_idxs].sum())
+        np.frombuffer(graph.token_ratio)[node_idxs] = (token_count[node_idxs] /
+                                                       total)
+
+        if changed is None:
+            return None
 
-            if (edge['p(token2|token)'] >= conf.intersection_ratio and
-                    edge['p(token|token2)'] >= conf.intersection_ratio):
-                # Update alias graph
-                t1 = nodes[self.__get_major_alias(alias_graph, edge['token'])]
-                t2 = nodes[self.__get_major_alias(alias_graph, edge['token2'])]
+        return set(np.union1d(idx, idx2).tolist()) | changed
 
-                if t1['token'] == t2['token']:
+    def __calculate_relations(self, graph, affected=None, processes=1,
+                              use_numpy=False):
+        '''Calculate relations of affected nodes
+
+        :param set affected: Indexes of tokens whose relations are calculated
+            again. Relations of all nodes are calculated if it is None.
+        :param int processes: Number of processes comparing tokens
+        :param bool use_numpy: Find edges of relations with NumPy arrays
+        '''
+        # Positions of edges whose tokens are subsets or aliases
+        ratio = conf.intersection_ratio
+        if use_numpy:
+            relations = np.flatnonzero(
+                (np.frombuffer(graph.p_token2) >= ratio) |
+                (np.frombuffer(graph.p_token) >= ratio)).tolist()
+        else:
+            relations = [pos for pos in range(len(graph.edge_key))
+                         if (graph.p_token2[pos] >= ratio or
+                             graph.p_token[pos] >= ratio)]
+
+        # Relations are calculated in the order of token pairs instead of
+        # positions of edges, which depend on when edges are counted first,
+        # so that merged roots, the order of parents and aliases of similar
+        # subsets are the same as a whole build.
+        tokens, token_count = graph.tokens, graph.token_count
+        relations.sort(key=lambda pos: [
+            tokens[idx] for idx in graph.unpair(graph.edge_key[pos])])
+
+        # Merge nodes co-occurring with each other into alias sets. Every
+        # edge is merged so that roots are the same as a whole build.
+        alias_set = DisjointSet(len(tokens), token_count)
+        for pos in relations:
+            if graph.p_token2[pos] >= ratio and graph.p_token[pos] >= ratio:
+                alias_set.union(*graph.unpair(graph.edge_key[pos]))
+
+        node_idxs = graph.node_indexes()
+        if affected is not None:
+            # Major aliases of sets having an affected node can be changed
+            affected_roots = {alias_set.find(idx) for idx in affected}
+            affected = affected | {idx for idx in node_idxs if
+                                   alias_set.find(idx) in affected_roots}
+
+        for idx in node_idxs:
+            if affected is None or idx in affected:
+                graph.alias[idx] = -1
+                graph.parents.pop(idx, None)
+                graph.num_subsets[idx] = 0  # Will be updated below
+
+        subsets = []  # Token indexes of subset edges, parents and children
+        len_relations = len(relations)
+        for i, pos in enumerate(relations):
+            if i and i % self.__batch_size == 0:
+                logger.info('%9s/%s relation calculated.' %
+                            (i, len_relations))
+
+            idx, idx2 = graph.unpair(graph.edge_key[pos])
+            if affected is None:
+                t1_affected = t2_affected = True
+            else:
+                t1_affected = idx in affected
+                t2_affected = idx2 in affected
+                if not t1_affected and not t2_affected:
                     continue
-                elif t1['token_count'] >= t2['token_count']:
-                    alias_graph[t2['token']] = t1['token']
-                else:
-                    alias_graph[t1['token']] = t2['token']
 
-            elif edge['p(token|token2)'] >= conf.intersection_ratio:
-                # Update num_subsets and parents
-                nodes[edge['token']]['num_subsets'] += 1
+            if (graph.p_token2[pos] >= conf.intersection_ratio and
+                    graph.p_token[pos] >= conf.intersection_ratio):
+                continue  # Already merged into the alias set
 
-                # Future work: Find parents by using string similarity
-                similarity = SequenceMatcher(a=edge['token'],
-                                             b=edge['token2']).ratio()
-                if similarity < 0.65:
-                    nodes[edge['token2']]['parents'].append(edge['token'])
-                else:
-                    if edge['token'] != edge['token2']:
-                        nodes[edge['token2']]['alias'] = edge['token']
+            elif graph.p_token[pos] >= conf.intersection_ratio:
+                # Update num_subsets and parents
+                if t1_affected:
+                    graph.num_subsets[idx] += 1
+                if t2_affected:
+                    subsets.append((idx, idx2, idx, idx2))
 
-            elif edge['p(token2|token)'] >= conf.intersection_ratio:
+            elif graph.p_token2[pos] >= conf.intersection_ratio:
                 # Update num_subsets and parents
-                nodes[edge['token2']]['num_subsets'] += 1
+                if t2_affected:
+                    graph.num_subsets[idx2] += 1
+                if t1_affected:
+                    subsets.append((idx, idx2, idx2, idx))
 
-                # Future work: Find parents by using string similarity
-                similarity = SequenceMatcher(a=edge['token'],
-                                             b=edge['token2']).ratio()
-                if similarity < 0.65:
-                    nodes[edge['token']]['parents'].append(edge['token2'])
-                else:
-                    if edge['token'] != edge['token2']:
-                        nodes[edge['token']]['alias'] = edge['token2']
+        # Future work: Find parents by using string similarity
+        similar = TokenSimilarity(0.65).are_similar(
+            [(tokens[idx], tokens[idx2]) for idx, idx2, _, _ in subsets],
+            processes)
+        for (idx, idx2, parent, child), is_similar in zip(subsets, similar):
+            if not is_similar:
+                graph.parents.setdefault(child, []).append(parent)
+            else:
+                if idx != idx2:
+                    graph.alias[child] = parent
 
-        # Update current alias to major alias by referring to the alias graph
-#         for token, alias in alias_graph.items():
-#             if alias is not None:
-#                 nodes[token]['alias'] = self.__get_major_alias(alias_graph,
-#                                                                alias)
+        # Update current alias to major alias by referring to the alias set
+        for idx in node_idxs:
+            if affected is None or idx in affected:
+                major_alias = alias_set.find(idx)
+                if major_alias != idx:
+                    graph.alias[idx] = major_alias
 
         # Remove ancestors from parents of nodes
 #         for node in nodes.values():
@@ -302,72 +1079,72 @@ class SumavGraphBuilder(SumavPostgresConnector):
 #
 #         return ancestors
 
-    def __get_major_alias(self, alias_graph, token):
-        # print(alias_graph[token], token)
-        if alias_graph[token] is None:
-            return token
-        else:
-            return self.__get_major_alias(alias_graph, alias_graph[token])
+    def __insert_nodes_and_edges(self, graph):
+        tokens = graph.tokens
+        nodes = graph.node_indexes()
+
+        def stat_rows():
+            for idx, tkn in enumerate(tokens):
+                yield tkn, graph.token_count[idx], graph.row_count[idx]
+
+        def node_rows():
+            # Importance and generality are static terms of scores of nodes
+            for idx in nodes:
+                alias = graph.alias[idx]
+                yield (graph.node_id[idx], tokens[idx],
+                       tokens[alias] if alias >= 0 else 'None',
+                       [tokens[p] for p in graph.parents.get(idx, [])],
+                       graph.token_count[idx], graph.row_count[idx],
+                       graph.token_ratio[idx], graph.num_subsets[idx],
+                       graph.token_count[idx] / graph.row_count[idx],
+                       graph.num_subsets[idx] / len(nodes))
 
-    def __insert_nodes_and_edges(self, nodes, edges):
+        def edge_rows():
+            for pos, key in enumerate(graph.edge_key):
+                idx, idx2 = graph.unpair(key)
+                yield (graph.edge_id[pos], tokens[idx], tokens[idx2],
+                       graph.p_token2[pos], graph.p_token[pos],
+                       graph.edge_count[pos])
+
+        tables = [
+            ('token_stat', ['token', 'token_count', 'row_count'], stat_rows),
+            ('token_node', ['id', 'token', 'alias', 'parents', 'token_count',
+                            'row_count', 'token_ratio', 'num_subsets',
+                            'importance', 'generality'],
+             node_rows),
+            ('token_edge', ['id', 'token', 'token2', 'p(token2|token)',
+                            'p(token|token2)', 'intersection_row_count'],
+             edge_rows)]
         with self._conn.cursor() as cur:
-            # For nodes
-            cur.execute('TRUNCATE TABLE token_node')
-            vals = []
-            len_nodes = len(nodes)
-            for i in range(1, len_nodes + 1):
-                _, v = nodes.popitem()
-                vals.append("%s,'%s','%s','{%s}',%s,%s,%s,%s" % (
-                    v['id'], v['token'], v['alias'], ','.join(v['parents']),
-                    v['token_count'], v['row_count'], v['token_ratio'],
-                    v['num_subsets']))
-
-                if len(vals) >= self.__batch_size:
-                    cur.execute('INSERT INTO token_node(id,token,alias,parents'
-                                ',token_count,row_count,token_ratio,'
-                                'num_subsets) VALUES(%s)' % '),('.join(vals))
-                    vals = []
-                    logger.info('%9s/%s nodes inserted in token_node.' %
-                                (i, len_nodes))
-
-            if len(vals) > 0:
-                cur.execute('INSERT INTO token_node(id,token,alias,parents'
-                            ',token_count,row_count,token_ratio,'
-                            'num_subsets) VALUES(%s)' % '),('.join(vals))
-                vals = []
-                logger.info('%9s/%s nodes inserted in token_node.' %
-                            (i, len_nodes))
-
-            # For edges
-            cur.execute('TRUNCATE TABLE token_edge')
-            vals = []
-            len_edges = len(edges)
-            for i in range(1, len_edges + 1):
-                _, v = edges.popitem()
-                vals.append("%s,'%s','%s',%s,%s,%s" % (
-                    v['id'], v['token'], v['token2'], v['p(token2|token)'],
-                    v['p(token|token2)'], v['intersection_row_count']))
-
-                if len(vals) >= self.__batch_size:
-                    cur.execute('INSERT INTO token_edge(id,token,token2,'
-                                '"p(token2|token)","p(token|token2)",'
-                                'intersection_row_count) VALUES (%s)' %
-                                '),('.join(vals))
-                    vals = []
-                    logger.info('%9s/%s edges inserted in token_edge.' %
-                                (i, len_edges))
-
-            if len(vals) > 0:
-                cur.execute('INSERT INTO token_edge(id,token,token2,'
-                            '"p(token2|token)","p(token|token2)",'
-                            'intersection_row_count) VALUES (%s)' %
-                            '),('.join(vals))
-                vals = []
-                logger.info('%9s/%s edges inserted in token_edge.' %
-                            (i, len_edges))
-
-    def __get_max_id(self, rows):
-        if len(rows) == 0:
-            return 0
-        else:
-            return max([v['id'] for v in rows.values()])
+            for table, columns, rows in tables:
+                # Rows are loaded to a staging table swapped with the table
+                # after loading all. Constraints are built after loading.
+                staging = table + '_new'
+                cur.execute('DROP TABLE IF EXISTS %s' % staging)
+                cur.execute('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS)' %
+                            (staging, table))
+                self.__copy_privileges(cur, table, staging)
+
+                self._copy_rows(cur, staging, columns, rows())
+
+                for name, definition in self.__constraints[table]:
+                    cur.execute('ALTER TABLE %s ADD CONSTRAINT %s %s' %
+                                (staging, staging + name[len(table):],
+                                 definition))
+                logger.info('Constraints of %s are built.' % staging)
+
+    def __copy_privileges(self, cur, table, new_table):
+        'Grant privileges of roles on table to them on new_table'
+        cur.execute("SELECT a.privilege_type,"
+                    "       CASE WHEN a.grantee=0 THEN 'PUBLIC' "
+                    "            ELSE quote_ident(r.rolname) END,"
+                    "       a.is_grantable "
+                    'FROM pg_class c '
+                    'CROSS JOIN LATERAL aclexplode(c.relacl) AS a '
+                    'LEFT JOIN pg_roles r ON r.oid=a.grantee '
+                    'WHERE c.oid=%s::regclass AND a.grantee<>c.relowner',
+                    [table])
+        for privilege, grantee, grantable in cur.fetchall():
+            cur.execute('GRANT %s ON %s TO %s%s' %
+                        (privilege, new_table, grantee,
+                         ' WITH GRANT OPTION' if grantable else ''))
@@ -0,0 +1,56 @@
+'''
+Disjoint set
+'''
+# Default packages
+from array import array
+
+# 3rd-party packages
+
+# Internal packages
+
+
+class DisjointSet:
+    '''Disjoint set of integers from 0 to size - 1
+
+    Sets are merged by the weights of their roots and paths are compressed
+    while finding roots, so that finding and merging take nearly constant
+    time.
+    '''
+    def __init__(self, size, weights):
+        '''
+        :param int size: Number of elements
+        :param weights: Weights of elements. The root of merged sets is the
+            root having the larger weight.
+        '''
+        self.__parent = array('q', range(size))
+        self.__weights = weights
+
+    def find(self, x):
+        'Return the root of the set having x'
+        parent = self.__parent
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+
+        return root
+
+    def union(self, x, y):
+        '''Merge sets having x and y
+
+        The root of x is the root of merged sets if their weights are equal.
+
+        :return: False if they are already in the same set
+        :rtype: bool
+        '''
+        root, root2 = self.find(x), self.find(y)
+        if root == root2:
+            return False
+
+        if self.__weights[root] >= self.__weights[root2]:
+            self.__parent[root2] = root
+        else:
+            self.__parent[root] = root2
+
+        return True
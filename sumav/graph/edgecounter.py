@@ -0,0 +1,181 @@
+'''
+Edge counter
+'''
+# Default packages
+import os
+import heapq
+import logging
+import tempfile
+from array import array
+
+# 3rd-party packages
+
+# Internal packages
+
+logger = logging.getLogger(__name__)
+
+
+class EdgeCounter:
+    '''Counter of packed edge keys keeping a bounded number of edges in memory
+
+    Counts are accumulated in the dictionary counts. When spill_if_full() is
+    called with max_edges or more edges in it, the counts are sorted by key
+    and spilled to a run file in tmpdir. Every edge has an ordinal of the
+    order that it is counted first so that merge_runs() can restore the order.
+    '''
+    # Approximate memory of an edge in the dictionary and of sorting it
+    bytes_per_edge = 250
+    __chunk_size = 100000
+    __fan_in = 64  # Runs merged at once
+
+    def __init__(self, max_edges=None, tmpdir=None, shard=0):
+        '''
+        :param int max_edges: Edges in memory. Nothing is spilled if None.
+        :param str tmpdir: Directory for run files
+        :param int shard: Edges of a shard are ordered after those of
+            previous shards.
+        '''
+        self.max_edges = max_edges
+        self.tmpdir = tmpdir
+        self.counts = {}
+        self.runs = []
+        self.__ordinal = shard << 40  # Ordinal of the first edge in counts
+
+    def spill_if_full(self):
+        if self.max_edges is not None and len(self.counts) >= self.max_edges:
+            self.spill()
+
+    def spill(self):
+        'Write counts sorted by key to a run file and clear them'
+        records = sorted(zip(self.counts.keys(),
+                             range(self.__ordinal,
+                                   self.__ordinal + len(self.counts)),
+                             self.counts.values()))
+        self.runs.append(self.__write_run(records, self.tmpdir))
+        logger.debug('%s edges are spilled to %s.' %
+                     (len(records), self.runs[-1]))
+        self.__ordinal += len(self.counts)
+        self.counts.clear()
+
+    def result(self):
+        '''Return counted edges
+
+        :return: packed keys and counts in the order that edges are counted
+            first, and run files. If max_edges is given, every edge is in
+            the run files.
+        :rtype: tuple
+        '''
+        if self.max_edges is None:
+            return (array('Q', self.counts.keys()),
+                    array('q', self.counts.values()), [])
+
+        if self.counts:
+            self.spill()
+        return array('Q'), array('q'), self.runs
+
+    @classmethod
+    def merge_runs(cls, runs, max_edges, tmpdir):
+        '''Merge run files and yield the sums of counts of edges
+
+        Run files are removed after merging them. At most max_edges records
+        are buffered in memory at once regardless of the number of runs.
+
+        :return: chunks of packed keys and counts in the order that edges are
+            counted first
+        :rtype: generator
+        '''
+        # Sum counts of the same key and sort them by ordinal again
+        ordered_runs, records = [], []
+        last_key, first, total = None, None, 0
+        runs, merged = cls.__merge(runs, max_edges, tmpdir)
+        for key, ordinal, cnt in merged:
+            if key != last_key:
+                if last_key is not None:
+                    records.append((first, last_key, total))
+                    if len(records) >= max_edges:
+                        records.sort()
+                        ordered_runs.append(cls.__write_run(records, tmpdir))
+                        records = []
+                last_key, first, total = key, ordinal, 0
+            total += cnt
+        if last_key is not None:
+            records.append((first, last_key, total))
+        records.sort()
+        ordered_runs.append(cls.__write_run(records, tmpdir))
+        del records
+        for run in runs:
+            os.remove(run)
+        logger.info('Runs are merged to %s runs ordered by appearance.' %
+                    len(ordered_runs))
+
+        size = min(cls.__chunk_size, max_edges)
+        keys, counts = array('Q'), array('q')
+        ordered_runs, merged = cls.__merge(ordered_runs, max_edges, tmpdir)
+        for _, key, cnt in merged:
+            keys.append(key)
+            counts.append(cnt)
+            if len(keys) >= size:
+                yield keys, counts
+                keys, counts = array('Q'), array('q')
+        if keys:
+            yield keys, counts
+        for run in ordered_runs:
+            os.remove(run)
+
+    @classmethod
+    def __merge(cls, runs, max_edges, tmpdir):
+        '''Merge sorted records of runs
+
+        Runs are merged into fewer runs by intermediate passes until at most
+        __fan_in runs are left. Readers of runs buffer max_edges records in
+        total.
+
+        :return: runs left, which the caller removes after merging them, and
+            a generator of their records in order
+        :rtype: tuple
+        '''
+        runs = list(runs)
+        while len(runs) > cls.__fan_in:
+            logger.info('%s runs are merged to %s runs.' %
+                        (len(runs), -(-len(runs) // cls.__fan_in)))
+            size = max(1, max_edges // (cls.__fan_in + 1))  # With the writer
+            merged_runs = []
+            for i in range(0, len(runs), cls.__fan_in):
+                group = runs[i:i + cls.__fan_in]
+                merged_runs.append(cls.__write_run(
+                    heapq.merge(*[cls.__read_run(r, size) for r in group]),
+                    tmpdir, size))
+                for run in group:
+                    os.remove(run)
+            runs = merged_runs
+
+        size = max(1, max_edges // max(1, len(runs)))
+        return runs, heapq.merge(*[cls.__read_run(r, size) for r in runs])
+
+    @classmethod
+    def __write_run(cls, records, tmpdir, size=__chunk_size):
+        'Write records to a run file buffering size records at once'
+        fd, path = tempfile.mkstemp(suffix='.run', dir=tmpdir)
+        with os.fdopen(fd, 'wb') as f:
+            buf = []
+            for record in records:
+                buf.append(record)
+                if len(buf) >= size:
+                    array('Q', [v for r in buf for v in r]).tofile(f)
+                    buf = []
+            array('Q', [v for r in buf for v in r]).tofile(f)
+
+        return path
+
+    @classmethod
+    def __read_run(cls, path, size):
+        'Yield records of a run file reading size records at once'
+        with open(path, 'rb') as f:
+            while True:
+                chunk = array('Q')
+                chunk.frombytes(f.read(size * 3 * chunk.itemsize))
+                if not chunk:
+                    break
+
+                for i in range(0, len(chunk), 3):
+                    yield chunk[i], chunk[i + 1], chunk[i + 2]
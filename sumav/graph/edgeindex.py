@@ -0,0 +1,101 @@
+'''
+Edge index
+'''
+# Default packages
+from array import array
+from bisect import bisect_left
+
+# 3rd-party packages
+
+# Internal packages
+
+
+class EdgeIndex:
+    '''Adjacency index of edges between nodes
+
+    Every edge is stored in both directions in compressed rows. Edges of the
+    node idx are at edge_offsets[idx]:edge_offsets[idx + 1] and ordered by the
+    indexes of the other nodes, which are indexes of tokens in the byte order.
+    '''
+    def __init__(self, token, find, edge_offsets, edge_other, p_other,
+                 p_node, edge_count):
+        '''
+        :param token: Function returning the token of an index
+        :param find: Function returning the index of a token or -1
+        :param edge_other: Indexes of the other nodes
+        :param p_other: p(other|node) of edges
+        :param p_node: p(node|other) of edges
+        :param edge_count: intersection_row_count of edges
+        '''
+        self.__token = token
+        self.__find = find
+        self.edge_offsets = edge_offsets
+        self.edge_other = edge_other
+        self.p_other = p_other
+        self.p_node = p_node
+        self.edge_count = edge_count
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        'Index edges of a snapshot without copying them'
+        return cls(snapshot.token, snapshot.index, snapshot.edge_offsets,
+                   snapshot.edge_other, snapshot.p_other, snapshot.p_node,
+                   snapshot.edge_count)
+
+    @classmethod
+    def from_rows(cls, tokens, edges):
+        '''Index edges in memory
+
+        :param list tokens: Tokens of nodes in the byte order
+        :param iterable edges: Rows of token, token2, p(token2|token),
+            p(token|token2) and intersection_row_count of both directions
+            ordered by token and token2 in the byte order
+        '''
+        index = {tkn: idx for idx, tkn in enumerate(tokens)}
+        edge_offsets = array('q', [0] * (len(tokens) + 1))
+        edge_arrays = [array('i'), array('d'), array('d'), array('q')]
+        for tkn, tkn2, p_token2, p_token, cnt in edges:
+            edge_offsets[index[tkn] + 1] += 1
+            for arr, val in zip(edge_arrays, (index[tkn2], p_token2, p_token,
+                                               cnt)):
+                arr.append(val)
+        for idx in range(len(tokens)):
+            edge_offsets[idx + 1] += edge_offsets[idx]
+
+        def find(token):
+            return index.get(token, -1)
+
+        return cls(tokens.__getitem__, find, edge_offsets, *edge_arrays)
+
+    def edge(self, token, token2):
+        '''Return an edge from token to token2
+
+        :return: p(token2|token), p(token|token2) and intersection_row_count
+            or None if they are not connected
+        :rtype: tuple
+        '''
+        idx, idx2 = self.__find(token), self.__find(token2)
+        if idx < 0 or idx2 < 0:
+            return None
+
+        hi = self.edge_offsets[idx + 1]
+        pos = bisect_left(self.edge_other, idx2, self.edge_offsets[idx], hi)
+        if pos < hi and self.edge_other[pos] == idx2:
+            return self.p_other[pos], self.p_node[pos], self.edge_count[pos]
+
+        return None
+
+    def edges(self, token):
+        '''Return edges from token in the byte order of the other tokens
+
+        :return: tuples of token2 and the edge in the form of edge()
+        :rtype: list
+        '''
+        idx = self.__find(token)
+        if idx < 0:
+            return []
+
+        return [(self.__token(self.edge_other[pos]), self.p_other[pos],
+                 self.p_node[pos], self.edge_count[pos])
+                for pos in range(self.edge_offsets[idx],
+                                 self.edge_offsets[idx + 1])]
@@ -0,0 +1,89 @@
+'''
+LRU cache
+'''
+# Default packages
+import sys
+from collections import OrderedDict
+
+# 3rd-party packages
+
+# Internal packages
+
+
+class LRUCache:
+    '''Cache evicting the least recently used entries over its limits
+
+    Memory of an entry is approximated by the sizes of the objects of its key
+    and value. Entries are of a generation of the graph and all of them are
+    invalidated when the generation changes.
+    '''
+    def __init__(self, max_size=0, max_memory=0, generation=None):
+        '''
+        :param int max_size: Number of entries. Not limited if 0.
+        :param float max_memory: Megabytes of entries. Not limited if 0.
+        :param int generation: Id of the build of the graph
+        '''
+        self.max_size = max_size
+        self.max_memory = int(max_memory * 1024 * 1024)
+        self.generation = generation
+        self.memory = 0
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+        self.__entries = OrderedDict()  # Key to a tuple of value and size
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get(self, key, default=None):
+        entry = self.__entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        self.__entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value):
+        size = self.__sizeof(key) + self.__sizeof(value)
+        if self.max_memory and size > self.max_memory:
+            return
+
+        old = self.__entries.pop(key, None)
+        if old is not None:
+            self.memory -= old[1]
+        self.__entries[key] = (value, size)
+        self.memory += size
+
+        while ((self.max_size and len(self.__entries) > self.max_size) or
+               (self.max_memory and self.memory > self.max_memory)):
+            _, (_, size) = self.__entries.popitem(last=False)
+            self.memory -= size
+            self.evictions += 1
+
+    def invalidate(self, generation):
+        'Clear entries if they are not of generation'
+        if generation == self.generation:
+            return
+
+        if self.__entries:
+            self.invalidations += 1
+        self.__entries.clear()
+        self.memory = 0
+        self.generation = generation
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'entries': len(self.__entries), 'memory': self.memory,
+                'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'generation': self.generation}
+
+    @classmethod
+    def __sizeof(cls, obj):
+        size = sys.getsizeof(obj)
+        if isinstance(obj, (tuple, list)):
+            size += sum(cls.__sizeof(o) for o in obj)
+
+        return size
@@ -115,7 +115,11 @@ class SumavGraphManager(SumavPostgresConnector):
                 '--file=%s' % ntf.name,
             ]
             if not with_detection:
-                proc_args.append('--table=token_*')
+                # The build log tells searchers the generation of the graph
+                proc_args += ['--table=token_*', '--table=graph_build_log']
+            # Staging tables and the previous graph of builds
+            proc_args += ['--exclude-table=token_*_new',
+                          '--exclude-table=token_*_old']
             self.__exec(proc_args)
 
             # Create empty a dst database
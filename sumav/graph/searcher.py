@@ -2,36 +2,310 @@
 Searcher
 '''
 # Default packages
+import os
 import math
+import time
+import select
 import logging
+import threading
+import multiprocessing as mp
+from array import array
 from copy import deepcopy
+from contextlib import contextmanager
+from itertools import islice
 from base64 import b16decode
 
 # 3rd-party packages
 import psycopg2
 from psycopg2.extras import RealDictCursor
+try:
+    import numpy as np
+except ImportError:
+    np = None  # Scores are calculated in python loops
 
 # Internal packages
+import sumav.conf as conf
 import sumav.utils as utils
 from sumav.dbconnector import SumavPostgresConnector
+from sumav.graph.lrucache import LRUCache
+from sumav.graph.edgeindex import EdgeIndex
+from sumav.graph.snapshot import GraphSnapshot, SnapshotNodes, SnapshotAliases
 
 logger = logging.getLogger(__name__)
 
 
 class SumavGraphSearcher(SumavPostgresConnector):
-    def __init__(self, user, password, database, host, port):
+    __batch_size = 1000
+    __hash_batch_size = 10000  # Hashes looked up by a query
+    __general_param = 225  # Default general_param
+    __snapshot_timeout = 300  # Seconds to wait for the snapshot of a build
+    __miss = object()  # Result which is not cached
+
+    def __init__(self, user, password, database, host, port,
+                 snapshot=conf.graph_snapshot,
+                 cache_size=conf.result_cache_size,
+                 cache_memory=conf.result_cache_memory):
         '''Connect to SumavPostgresConnector RDB
 
-        :param int processes: Number of processors to run
+        :param str snapshot: Path of a snapshot file written by the builder.
+            Nodes are mapped from it instead of loading them from RDB if it
+            is a snapshot of the last build.
+        :param int cache_size: Number of representative tokens cached per
+            token counts and parameters. Nothing is cached if both limits
+            are 0.
+        :param float cache_memory: Megabytes of cached representative tokens
         '''
         super().__init__(user, password, database, host, port)
 
-        # Load token nodes
-        with self._conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute('SELECT * FROM token_node')
-            self.nodes = {r['token']: r for r in cur.fetchall()}
-            self.alias = {tkn: r['alias'] if r['alias'] != 'None' else tkn
-                          for tkn, r in self.nodes.items()}
+        self.__snapshot_path = snapshot
+        self.__next_graph = None  # Graph loaded by the watcher
+        self.__graph_lock = threading.Lock()
+        self.__watcher = None
+        self.__wakeup = None  # Pipe waking up the watcher to stop it
+
+        self.snapshot = None
+        self.__set_graph(self.__load_graph(self._conn))
+
+        self.cache = None
+        if cache_size or cache_memory:
+            self.cache = LRUCache(cache_size, cache_memory, self.generation)
+
+    def __get_generation(self, conn):
+        '''Return the id of the last build
+
+        :return: None if no build is logged or graphs are dumped without
+            graph_build_log
+        :rtype: int
+        '''
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regclass('public.graph_build_log')")
+            if cur.fetchone()[0] is None:
+                return None
+
+            cur.execute('SELECT max(id) FROM graph_build_log')
+            return cur.fetchone()[0]
+
+    @contextmanager
+    def __read_graph(self, conn):
+        '''Read graph tables of a build in a transaction
+
+        Graph tables are locked before the transaction takes its snapshot so
+        that builds swap them either before or after the transaction.
+        '''
+        with conn.cursor() as cur:
+            cur.execute('BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY')
+        try:
+            with conn.cursor() as cur:
+                cur.execute('LOCK TABLE token_node,token_edge '
+                            'IN ACCESS SHARE MODE')
+            yield
+        except BaseException:
+            if not conn.closed:
+                with conn.cursor() as cur:
+                    cur.execute('ROLLBACK')
+            raise
+
+        with conn.cursor() as cur:
+            cur.execute('COMMIT')
+
+    def __load_graph(self, conn, edges=False):
+        '''Load nodes of the graph of the last build
+
+        :param bool edges: Load edges too if nodes are loaded from RDB
+        :return: generation, snapshot, nodes, aliases and the index of edges
+            or None if edges are not loaded
+        :rtype: tuple
+        '''
+        with self.__read_graph(conn):
+            generation = self.__get_generation(conn)
+            snapshot = self.__open_snapshot(self.__snapshot_path, generation)
+            if snapshot is not None:
+                return (generation, snapshot, SnapshotNodes(snapshot),
+                        SnapshotAliases(snapshot), None)
+
+            # Load token nodes
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute('SELECT * FROM token_node')
+                nodes = {r['token']: r for r in cur.fetchall()}
+                alias = {tkn: r['alias'] if r['alias'] != 'None' else tkn
+                         for tkn, r in nodes.items()}
+
+            return (generation, None, nodes, alias,
+                    self.__load_edges(conn, nodes) if edges else None)
+
+    def __set_graph(self, graph):
+        old_snapshot = self.snapshot
+        # Edges are loaded when they are required unless they are loaded
+        (self.generation, self.snapshot, self.nodes, self.alias,
+         self.__edges) = graph
+        self.__node_scores = None
+
+        if old_snapshot is not None and old_snapshot is not self.snapshot:
+            try:
+                old_snapshot.close()
+            except BufferError:  # Arrays of it are still used
+                pass
+
+    def __open_snapshot(self, path, generation):
+        if not path or not os.path.exists(path):
+            return None
+
+        try:
+            snapshot = GraphSnapshot(path)
+        except ValueError as e:  # Written in another format
+            logger.warning('%s Nodes are loaded from RDB.' % e)
+            return None
+
+        if snapshot.generation != generation:
+            logger.warning('Snapshot %s of build %s is not of the last build '
+                           '%s. Nodes are loaded from RDB.' %
+                           (path, snapshot.generation, generation))
+            snapshot.close()
+            return None
+
+        logger.info('Nodes are mapped from snapshot %s.' % path)
+        return snapshot
+
+    def __snapshot_is_behind(self, generation):
+        'Return whether the snapshot exists but it is not of generation yet'
+        path = self.__snapshot_path
+        if not path or not os.path.exists(path):
+            return False
+
+        try:
+            snapshot = GraphSnapshot(path)
+        except ValueError:
+            return False
+        behind = snapshot.generation != generation
+        snapshot.close()
+
+        return behind
+
+    def reload_graph(self):
+        '''Load the graph of the last build if it is not loaded
+
+        :return: True if a graph is loaded
+        :rtype: bool
+        '''
+        self._reconnect_if_closed()
+        generation = self.__get_generation(self._conn)
+        if generation == self.generation:
+            return False
+
+        with self.__graph_lock:
+            self.__next_graph = None
+        self.__set_graph(self.__load_graph(self._conn,
+                                           edges=self.__edges is not None))
+        logger.info('The graph of build %s is loaded.' % self.generation)
+
+        return True
+
+    def watch_graph(self, interval=conf.graph_poll_interval):
+        '''Load graphs of new builds in a background thread
+
+        The thread listens to notifications of builders and checks the last
+        build every interval seconds. A loaded graph is swapped in before the
+        next request. If a snapshot is used, the graph is loaded after the
+        snapshot of the build is written. Edges of the graph are loaded too
+        if edges of the current graph are loaded.
+
+        :param float interval: Seconds between checks
+        '''
+        if self.__watcher is not None:
+            return
+
+        self.__wakeup = os.pipe()
+        self.__watcher = threading.Thread(target=self.__watch,
+                                          args=(interval,), daemon=True)
+        self.__watcher.start()
+
+    def __watch(self, interval):
+        conn, loaded, waiting = None, self.generation, None
+        notified = None  # The last build notified by builders
+        while True:
+            try:
+                if conn is None or conn.closed:
+                    conn = self._connect(**self._dbkwargs)
+                    with conn.cursor() as cur:
+                        cur.execute('LISTEN %s' % conf.graph_channel)
+
+                generation = self.__get_generation(conn)
+                if generation == loaded:
+                    pass
+                elif (self.__snapshot_is_behind(generation) and
+                      not self.__snapshot_is_skipped(generation, notified,
+                                                     waiting)):
+                    if waiting is None or waiting[0] != generation:
+                        logger.info('Wait for the snapshot of build %s.' %
+                                    generation)
+                        waiting = (generation, time.time())
+                else:
+                    graph = self.__load_graph(
+                        conn, edges=self.__edges is not None)
+                    with self.__graph_lock:
+                        self.__next_graph = graph
+                    loaded = graph[0]
+                    logger.info('The graph of build %s is loaded.' %
+                                loaded)
+            except psycopg2.Error as e:
+                logger.exception(e)
+                if conn is not None:
+                    conn.close()  # Connect again after the interval
+            except Exception as e:  # Tried again after the interval
+                logger.exception(e)
+
+            # Wait for a notification, the interval or stopping
+            waits = [self.__wakeup[0]]
+            if conn is not None and not conn.closed:
+                waits.append(conn)
+            readable = select.select(waits, [], [], interval)[0]
+            if self.__wakeup[0] in readable:
+                break
+            if conn in readable:
+                conn.poll()
+                for notify in conn.notifies:
+                    if notify.payload.isdigit():
+                        notified = int(notify.payload)
+                conn.notifies.clear()
+
+        if conn is not None:
+            conn.close()
+
+    def __snapshot_is_skipped(self, generation, notified, waiting):
+        '''Return whether the snapshot of generation will not be written
+
+        Builders notify a build after writing its snapshot, so that the build
+        did not write it if the build is notified. Snapshots of builds whose
+        notifications are missed are waited for up to snapshot_timeout
+        seconds. Nodes are loaded from RDB then as loading the first graph.
+
+        :param int notified: The last build notified
+        :param tuple waiting: The build waited for and when it was found
+        '''
+        if generation is None or notified == generation:
+            return True
+        elif waiting is not None and waiting[0] == generation:
+            return time.time() - waiting[1] >= self.__snapshot_timeout
+
+        return False
+
+    def __swap_graph(self):
+        'Swap in the graph loaded by the watcher between requests'
+        if self.__next_graph is None:
+            return
+
+        with self.__graph_lock:
+            graph, self.__next_graph = self.__next_graph, None
+        if graph is not None:
+            self.__set_graph(graph)
+            logger.info('The graph of build %s is swapped in.' % graph[0])
+
+    def _connect(self, user, password, database, host, port):
+        # Queries must not keep transactions locking graph tables which are
+        # swapped by builds
+        conn = super()._connect(user, password, database, host, port)
+        conn.autocommit = True
+        return conn
 
     def get_representative_token(self, av_labels=None, tokens=None,
                                  sha256=None, md5=None, top_n=None,
@@ -46,9 +320,9 @@ class SumavGraphSearcher(SumavPostgresConnector):
         :return: tokens with space delimiter
         :rtype: str
         '''
+        self.__swap_graph()
         if len(self.nodes) == 0:
             raise Exception('Sumav graph does not exists.')
-        self._reconnect_if_closed()
 
         if tokens is not None:
             pass
@@ -63,6 +337,7 @@ class SumavGraphSearcher(SumavPostgresConnector):
 
         # Get tokens from RDB
         if tokens is None:
+            self._reconnect_if_closed()
             with self._conn.cursor(cursor_factory=RealDictCursor) as cur:
                 cur.execute('select tokens from detection where %s' % where,
                             vals)
@@ -75,10 +350,6 @@ class SumavGraphSearcher(SumavPostgresConnector):
                 if tokens is None:
                     return None
 
-        # Transform tokens to alias tokens
-        if alias:
-            tokens = [self.alias.get(tkn, tkn) for tkn in tokens]
-
         # Get token count of current detection names
         tkn_cnt = {}
         for token in tokens:
@@ -87,36 +358,45 @@ class SumavGraphSearcher(SumavPostgresConnector):
             else:
                 tkn_cnt[token] = 1
 
-        # Get tokens with information
-        tkn_info_list = [self.nodes[tkn] for tkn in tkn_cnt.keys()
-                         if tkn in self.nodes]
+        cache = self.__get_cache()
+        if cache is not None:
+            key = (tuple(tkn_cnt.items()), alias, top_n, weight_param,
+                   general_param, return_none_less_than)
+            out = cache.get(key, self.__miss)
+            if out is self.__miss:
+                out = self.__select_token(tkn_cnt, top_n, weight_param,
+                                          general_param, alias,
+                                          return_none_less_than)
+                cache.put(key, out)
+            return out[:] if isinstance(out, list) else out
+
+        return self.__select_token(tkn_cnt, top_n, weight_param,
+                                   general_param, alias,
+                                   return_none_less_than)
+
+    def __select_token(self, tkn_cnt, top_n, weight_param, general_param,
+                       alias, return_none_less_than):
+        '''Select representative tokens of token counts'''
+        # Transform tokens to alias tokens
+        if alias:
+            tkn_cnt = self.__alias_counts(tkn_cnt)
 
-        # Select a representative token from token depends on its info
-        candidates = set()
-        for tkn_info in tkn_info_list:
-            if tkn_info['token'] in candidates:
-                continue
+        # Get indexes of tokens which are nodes
+        find, importance, generality = self.__get_node_scores(general_param)
+        node_idx = {tkn: find(tkn) for tkn in tkn_cnt.keys()}
 
-            candidates.add(tkn_info['token'])
+        # Select a representative token from token depends on its info
+        candidates = set(tkn for tkn in tkn_cnt.keys() if node_idx[tkn] >= 0)
 
         if len(candidates) > 0:
-            # Calculate score to select a represenation token.
+            # Calculate score to select a represenation token. Importance and
+            # generality of nodes are calculated in advance.
             tkn_score = {}
-            for tkn in tkn_cnt.keys():
+            for tkn in candidates:
+                idx = node_idx[tkn]
                 wei_func_ret = self.__weight_func(tkn_cnt[tkn], weight_param)
-
-                if tkn in self.nodes:
-                    tki = self.nodes[tkn]
-                    imp_func_ret = self.__importance_func(tki['token_count'],
-                                                          tki['row_count'])
-                    gen_func_ret = self.__general_func(tki['num_subsets'],
-                                                       len(self.nodes),
-                                                       general_param)
-
-                    tkn_score[tkn] = wei_func_ret + imp_func_ret - gen_func_ret
-
-                else:  # Given token not exists in Sumav graph nodes.
-                    tkn_score[tkn] = wei_func_ret
+                tkn_score[tkn] = (wei_func_ret + importance[idx] -
+                                  generality[idx])
 
             # sort by token score in decending order
             # with keeping candiate order
@@ -131,6 +411,262 @@ class SumavGraphSearcher(SumavPostgresConnector):
             else:
                 return out[:top_n]
 
+    def get_representative_tokens(self, av_labels_list=None, tokens_list=None,
+                                  sha256_list=None, md5_list=None,
+                                  top_n=None, weight_param=4.1,
+                                  general_param=225, alias=False,
+                                  return_none_less_than=0):
+        '''Get representative tokens of samples at once
+
+        Results are the same as get_representative_token() of each sample.
+        Scores of tokens of all samples are calculated in arrays.
+
+        :param list av_labels_list: AV labels of samples
+        :param list tokens_list: Tokens of samples used instead of AV labels
+        :param list sha256_list: Hashes of samples whose tokens are looked up
+            in RDB at once
+        :param list md5_list: Hashes of samples whose tokens are looked up in
+            RDB at once
+        :param int top_n: Get top_n tokens sort by importance.
+        :return: results in the order of samples. Results of hashes which do
+            not exist in RDB are None.
+        :rtype: list
+        '''
+        self.__swap_graph()
+        if len(self.nodes) == 0:
+            raise Exception('Sumav graph does not exists.')
+
+        if tokens_list is not None:
+            pass
+        elif av_labels_list is not None:
+            tokens_list = [None if labels is None else
+                           utils.make_tokens(labels, remove_duplicate=False)
+                           for labels in av_labels_list]
+        elif sha256_list is not None:
+            tokens_list = self.get_tokens_of_hashes(sha256_list, 'sha256')
+        elif md5_list is not None:
+            tokens_list = self.get_tokens_of_hashes(md5_list, 'md5')
+        else:
+            return []
+
+        return self.__get_representative_tokens(
+            tokens_list, top_n, weight_param, general_param, alias,
+            return_none_less_than)
+
+    def get_tokens_of_hashes(self, hashes, column='sha256', conn=None):
+        '''Get tokens of samples from RDB by querying indexed hashes at once
+
+        :param list hashes: Hex strings of hashes
+        :param str column: sha256 or md5
+        :param connection conn: Connection used instead of the connection of
+            the searcher
+        :return: tokens in the order of hashes. Tokens of hashes which do not
+            exist in RDB are None.
+        :rtype: list
+        '''
+        if column not in ('sha256', 'md5'):
+            raise ValueError('Unknown hash %s' % column)
+
+        hashes = [h.lower() if h is not None else None for h in hashes]
+        found = {}
+        if conn is None:
+            self._reconnect_if_closed()
+            conn = self._conn
+        with conn.cursor() as cur:
+            keys = sorted(set(h for h in hashes if h is not None))
+            for i in range(0, len(keys), self.__hash_batch_size):
+                cur.execute(
+                    "SELECT encode(%s,'hex'),tokens FROM detection "
+                    "WHERE %s=ANY(%%s)" % (column, column),
+                    [[self.__hex_to_bytes(h) for h in
+                      keys[i:i + self.__hash_batch_size]]])
+                for hexstr, tokens in cur:
+                    found.setdefault(hexstr, tokens)
+
+        logger.debug('%s of %s hashes exist in RDB.' %
+                     (len(found), len(keys)))
+        return [found.get(h) for h in hashes]
+
+    def __get_representative_tokens(self, tokens_list, top_n=None,
+                                    weight_param=4.1, general_param=225,
+                                    alias=False, return_none_less_than=0):
+        cache = self.__get_cache()
+        find, importance, generality = self.__get_node_scores(general_param)
+        node_idx, weights = {}, {}
+        results = [None] * len(tokens_list)
+        samples = []  # Index, key, token counts and candidates to score
+        same = {}  # Keys to indexes of the first samples having them
+        duplicates = []
+        cand_idxs, cand_weights = array('q'), array('d')
+        for i, tokens in enumerate(tokens_list):
+            if tokens is None:
+                continue
+
+            tkn_cnt = {}
+            for token in tokens:
+                if token in tkn_cnt:
+                    tkn_cnt[token] += 1
+                else:
+                    tkn_cnt[token] = 1
+
+            key = None
+            if cache is not None:
+                key = (tuple(tkn_cnt.items()), alias, top_n, weight_param,
+                       general_param, return_none_less_than)
+                if key in same:
+                    duplicates.append((i, same[key]))
+                    continue
+
+                out = cache.get(key, self.__miss)
+                if out is not self.__miss:
+                    results[i] = out[:] if isinstance(out, list) else out
+                    continue
+                same[key] = i
+
+            # Transform tokens to alias tokens
+            if alias:
+                tkn_cnt = self.__alias_counts(tkn_cnt)
+
+            for tkn in tkn_cnt:
+                if tkn not in node_idx:
+                    node_idx[tkn] = find(tkn)
+
+            # Candidates are ordered by the set as get_representative_token()
+            candidates = list(set(tkn for tkn in tkn_cnt
+                                  if node_idx[tkn] >= 0))
+            for tkn in candidates:
+                cnt = tkn_cnt[tkn]
+                if cnt not in weights:
+                    weights[cnt] = self.__weight_func(cnt, weight_param)
+                cand_idxs.append(node_idx[tkn])
+                cand_weights.append(weights[cnt])
+            samples.append((i, key, tkn_cnt, candidates))
+
+        # weight + importance - generality of every candidate
+        if np is not None:
+            idxs = np.frombuffer(cand_idxs, dtype=np.int64)
+            scores = (np.frombuffer(cand_weights) +
+                      np.frombuffer(importance)[idxs] -
+                      np.frombuffer(generality)[idxs]).tolist()
+        else:
+            scores = [wei + importance[idx] - generality[idx]
+                      for idx, wei in zip(cand_idxs, cand_weights)]
+
+        pos = 0
+        for sample_no, key, tkn_cnt, candidates in samples:
+            result = None
+            if candidates:
+                out = list(zip(candidates,
+                               scores[pos:pos + len(candidates)]))
+                pos += len(candidates)
+                if top_n is None:
+                    best = max(out, key=lambda i: i[1])  # First one of ties
+                else:
+                    out = sorted(out, key=lambda i: i[1], reverse=True)
+                    best = out[0]
+
+                if tkn_cnt[best[0]] <= return_none_less_than:
+                    result = None
+                elif top_n is None:
+                    result = best[0]
+                else:
+                    result = out[:top_n]
+
+            if cache is not None:
+                cache.put(key, result)
+            results[sample_no] = result
+
+        for i, first in duplicates:
+            out = results[first]
+            results[i] = out[:] if isinstance(out, list) else out
+
+        return results
+
+    def __alias_counts(self, tkn_cnt):
+        '''Return counts of alias tokens of token counts
+
+        Alias tokens are ordered as if they were counted after transforming
+        tokens to alias tokens.
+        '''
+        alias_cnt = {}
+        for tkn, cnt in tkn_cnt.items():
+            tkn = self.alias.get(tkn, tkn)
+            alias_cnt[tkn] = alias_cnt.get(tkn, 0) + cnt
+
+        return alias_cnt
+
+    def __get_cache(self):
+        '''Return the cache of representative tokens after invalidating it if
+        the graph is of another generation
+        '''
+        if self.cache is not None:
+            self.cache.invalidate(self.generation)
+
+        return self.cache
+
+    def cache_stats(self):
+        '''Get statistics of the cache of representative tokens
+
+        :return: entries, memory, hits, misses, hit_rate, evictions,
+            invalidations and generation or None if nothing is cached
+        :rtype: dict
+        '''
+        return self.cache.stats() if self.cache is not None else None
+
+    def __get_node_scores(self, general_param):
+        '''Return a function finding indexes of tokens, and importance and
+        generality terms of nodes in arrays
+
+        Importance and generality ratios of nodes are stored by the builder.
+        Generality terms of the default general_param are prepared with the
+        ratios, and those of the last other general_param are kept.
+        '''
+        if self.__node_scores is None:
+            self.__node_scores = self.__load_node_scores() + ({},)
+            self.__get_node_scores(self.__general_param)
+
+        find, importance, general_ratios, generality = self.__node_scores
+        if general_param not in generality:
+            if np is not None:
+                terms = array('d')
+                terms.frombytes((np.frombuffer(general_ratios) *
+                                 general_param).tobytes())
+            else:
+                terms = array('d', [self.__general_func(ratio, general_param)
+                                    for ratio in general_ratios])
+            for param in list(generality):
+                if param != self.__general_param:
+                    del generality[param]  # Arrays are as large as nodes
+            generality[general_param] = terms
+
+        return find, importance, generality[general_param]
+
+    def __load_node_scores(self):
+        if self.snapshot is not None:
+            return (self.snapshot.index, self.snapshot.importance,
+                    self.snapshot.generality)
+
+        index = {tkn: idx for idx, tkn in enumerate(self.nodes)}
+
+        def find(token):
+            return index.get(token, -1)
+
+        # Graphs built before the columns are added have nulls, and those
+        # which are not migrated do not have the columns
+        importance, general_ratios = array('d'), array('d')
+        for node in self.nodes.values():
+            if node.get('importance') is not None:
+                importance.append(node['importance'])
+            else:
+                importance.append(self.__importance_func(node['token_count'],
+                                                         node['row_count']))
+            if node.get('generality') is not None:
+                general_ratios.append(node['generality'])
+            else:
+                general_ratios.append(node['num_subsets'] / len(self.nodes))
+
+        return find, importance, general_ratios
+
     def get_related_tokens(self, token):
         '''Get related sets of token
 
@@ -138,53 +674,40 @@ class SumavGraphSearcher(SumavPostgresConnector):
         :return: sets with information
         :rtype: dict
         '''
-        self._reconnect_if_closed()
-
+        self.__swap_graph()
         out = {'supersets': [], 'subsets': [], 'equalsets': [], 'info': {}}
         token = token.lower()
 
-        with self._conn.cursor(cursor_factory=RealDictCursor) as curs:
-            curs.execute('SELECT * FROM token_node')
-            tokens = {r['token']: r for r in curs}
-
-            curs.execute('SELECT * FROM token_edge WHERE '
-                         'token=%s or token2=%s', (token, token))
-
-            for edge in curs:
-                if token == edge['token']:
-                    token2 = edge['token2']
-                else:
-                    token2 = edge['token']
-
-                ret = self.compare_tokens(token, token2, without_rowcount=True)
-                if ret is None:
-                    continue
-                elif ret['relation'] == '⊂':
-                    logger.debug(' Found %s(%.2f) ⊂ %s(%.2f)' % (
-                        token, ret['p(token2|token)'],
-                        token2, ret['p(token|token2)']))
-                    out['supersets'].append(token2)
+        for token2, p_token2, p_token, cnt in self.__get_edges().edges(token):
+            ret = {'p(token2|token)': p_token2, 'p(token|token2)': p_token,
+                   'intersection_row_count': cnt,
+                   'relation': self.__relation(p_token2, p_token)}
+            if ret['relation'] == '⊂':
+                logger.debug(' Found %s(%.2f) ⊂ %s(%.2f)' % (
+                    token, ret['p(token2|token)'],
+                    token2, ret['p(token|token2)']))
+                out['supersets'].append(token2)
+                out['info']['%s_%s' % (token, token2)] = ret
+
+            elif ret['relation'] == '⊃':
+                logger.debug(' Found %s(%.2f) ⊃ %s(%.2f)' % (
+                    token, ret['p(token2|token)'],
+                    token2, ret['p(token|token2)']))
+                out['subsets'].append(token2)
+                out['info']['%s_%s' % (token, token2)] = ret
+
+            elif ret['relation'] == '=':
+                # Insert token in front that is more frequently used.
+                if (self.nodes[token]['token_count'] >
+                        self.nodes[token2]['token_count']):
+                    logger.debug(' Found %s(%.2f) = %s(%.2f)' % (
+                        token2, ret['p(token2|token)'], token,
+                        ret['p(token|token2)']))
+                    out['equalsets'].append(token2)
                     out['info']['%s_%s' % (token, token2)] = ret
-
-                elif ret['relation'] == '⊃':
-                    logger.debug(' Found %s(%.2f) ⊃ %s(%.2f)' % (
-                        token, ret['p(token2|token)'],
-                        token2, ret['p(token|token2)']))
-                    out['subsets'].append(token2)
-                    out['info']['%s_%s' % (token, token2)] = ret
-
-                elif ret['relation'] == '=':
-                    # Insert token in front that is more frequently used.
-                    if (tokens[token]['token_count'] >
-                            tokens[token2]['token_count']):
-                        logger.debug(' Found %s(%.2f) = %s(%.2f)' % (
-                            token2, ret['p(token2|token)'], token,
-                            ret['p(token|token2)']))
-                        out['equalsets'].append(token2)
-                        out['info']['%s_%s' % (token, token2)] = ret
-                else:
-                    pass
-                    # out['notequalsets'].append(token2)
+            else:
+                pass
+                # out['notequalsets'].append(token2)
 
         return out
 
@@ -197,37 +720,62 @@ class SumavGraphSearcher(SumavPostgresConnector):
         :return: relation with(out) row count
         :rtype: dict
         '''
-        self._reconnect_if_closed()
+        self.__swap_graph()
+        edge = self.__get_edges().edge(token, token2)
+        if edge is None:
+            return None
 
-        with self._conn.cursor(cursor_factory=RealDictCursor) as cur:
-            if token == min(token, token2):
-                cur.execute('select "p(token2|token)",'
-                            '"p(token|token2)",intersection_row_count '
-                            'from token_edge '
-                            'where token=%s and token2=%s', [token, token2])
-            else:
-                cur.execute('select "p(token2|token)" as "p(token|token2)",'
-                            '"p(token|token2)" as "p(token2|token)",'
-                            'intersection_row_count from token_edge '
-                            'where token=%s and token2=%s', [token2, token])
-            out = cur.fetchone()
-            if out is None:
-                return None
+        out = dict(zip(['p(token2|token)', 'p(token|token2)',
+                        'intersection_row_count'], edge))
+        out['relation'] = self.__relation(out['p(token2|token)'],
+                                          out['p(token|token2)'])
 
-            out['relation'] = self.__relation(out['p(token2|token)'],
-                                              out['p(token|token2)'])
+        if not without_rowcount:
+            out['cnt_token'] = self.nodes[token]['row_count']
+            out['cnt_token2'] = self.nodes[token2]['row_count']
 
-            if not without_rowcount:
-                cur.execute('select row_count from token_node where token=%s',
-                            [token])
-                row = cur.fetchone()
-                out['cnt_token'] = row['row_count']
+        return out
+
+    def __get_edges(self):
+        '''Return the index of edges. Edges are loaded from RDB once unless
+        they are mapped from the snapshot.
+        '''
+        if self.__edges is not None:
+            return self.__edges
 
-                cur.execute('select row_count from token_node where token=%s',
-                            [token2])
-                out['cnt_token2'] = cur.fetchone()['row_count']
+        if self.snapshot is not None:
+            self.__edges = EdgeIndex.from_snapshot(self.snapshot)
+            return self.__edges
 
-        return dict(out)
+        self._reconnect_if_closed()
+        with self.__read_graph(self._conn):
+            if self.__get_generation(self._conn) == self.generation:
+                self.__edges = self.__load_edges(self._conn, self.nodes)
+                return self.__edges
+
+        # Edges are of a new build. Load its nodes too.
+        with self.__graph_lock:
+            self.__next_graph = None
+        self.__set_graph(self.__load_graph(self._conn, edges=True))
+        logger.info('The graph of build %s is loaded.' % self.generation)
+
+        return self.__get_edges()
+
+    def __load_edges(self, conn, nodes):
+        with conn.cursor('edgecur', withhold=True) as cur:
+            cur.itersize = 100000
+            cur.execute(GraphSnapshot.edge_sql)
+            edges = EdgeIndex.from_rows(sorted(nodes), cur)
+        logger.info('%s edges are loaded.' % (len(edges.edge_other) // 2))
+
+        return edges
+
+    def load_edges(self):
+        '''Load edges of the graph in advance. Otherwise, they are loaded by
+        the first request comparing tokens.
+        '''
+        self.__swap_graph()
+        self.__get_edges()
 
     def get_detection_rows(self, user=None, password=None, database=None,
                            host=None, port=None, sha256=None, limit=None):
@@ -267,57 +815,171 @@ class SumavGraphSearcher(SumavPostgresConnector):
                     logger.info('%5s/%s processed..' % (i, total))
 
     def get_sumav_results(self, rows, top_n=None, weight_param=4.1,
-                          general_param=225, alias=False):
+                          general_param=225, alias=False, processes=1):
+        '''Label rows in chunks
+
+        :param int processes: Number of processes labeling chunks. Forked
+            processes share the loaded graph, and a bounded number of chunks
+            are labeled at once. Results are yielded in the order of rows.
+        '''
         logger.info('top_n=%s, weight_param=%s, general_param=%s' %
                     (top_n, weight_param, general_param))
+        self.__swap_graph()  # Rows are labeled by the same graph
+        if len(self.nodes) == 0:
+            raise Exception('Sumav graph does not exists.')
 
+        kwargs = {'top_n': top_n, 'weight_param': weight_param,
+                  'general_param': general_param, 'alias': alias}
+        if processes > 1:
+            labeled = self.__label_in_processes(self.__chunk(rows), processes,
+                                                kwargs)
+        else:
+            labeled = ((chunk, self.__get_representative_tokens(
+                tokens_list=[row['tokens'] for row in chunk], **kwargs))
+                for chunk in self.__chunk(rows))
+
+        for chunk, rep_tokens in labeled:
+            for row, rep_token in zip(chunk, rep_tokens):
+                # if rep_token is not None:
+                yield {'sha256': row['sha256'], 'md5': row['md5'],
+                       'ground_truth': row['ground_truth'],
+                       'sumav_label': rep_token}
+
+    def __chunk(self, rows):
+        chunk = []
         for row in rows:
-            rep_token = self.get_representative_token(
-                tokens=row['tokens'], top_n=top_n, weight_param=weight_param,
-                general_param=general_param, alias=alias)
-
-            # if rep_token is not None:
-            yield {'sha256': row['sha256'], 'md5': row['md5'],
-                    'ground_truth': row['ground_truth'],
-                    'sumav_label': rep_token}
+            chunk.append(row)
+            if len(chunk) >= self.__batch_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def __label_in_processes(self, chunks, processes, kwargs):
+        '''Yield chunks and their labels in order from processes
+
+        At most two chunks per process are sent to processes at once.
+        Processes are forked whatever the default start method is to share
+        the graph, which is not pickled with its connection to spawn them.
+        '''
+        # Arrays of scores are prepared before forking to share them
+        self.__get_node_scores(kwargs['general_param'])
+
+        ctx = mp.get_context('fork')
+        inque, outque = ctx.Queue(), ctx.Queue()
+        prs = [ctx.Process(target=self.__label_worker,
+                           args=(inque, outque, kwargs))
+               for _ in range(processes)]
+        for pr in prs:
+            pr.start()
+
+        pending, labels = {}, {}
+        try:
+            for chunk_no, chunk in enumerate(chunks):
+                pending[chunk_no] = chunk
+                inque.put((chunk_no, [row['tokens'] for row in chunk]))
+                yield from self.__yield_labels(outque, pending, labels,
+                                               prs, 2 * processes)
+            yield from self.__yield_labels(outque, pending, labels, prs, 1)
+        finally:
+            for pr in prs:
+                if pending:
+                    pr.terminate()
+                else:
+                    inque.put(None)
+            for pr in prs:
+                pr.join()
+
+    def __yield_labels(self, outque, pending, labels, prs, max_pending):
+        '''Yield the first pending chunks and their labels until fewer than
+        max_pending chunks are pending. It fails if any of processes prs is
+        killed, because chunks it took are never labeled.
+        '''
+        while len(pending) >= max_pending:
+            chunk_no = next(iter(pending))
+            while chunk_no not in labels:
+                done, rep_tokens, err = utils.get_from_processes(outque, prs)
+                if err is not None:
+                    raise Exception('Chunk %s failed: %s' % (done, err))
+                labels[done] = rep_tokens
+            yield pending.pop(chunk_no), labels.pop(chunk_no)
+
+    def __label_worker(self, inque, outque, kwargs):
+        for chunk_no, tokens_list in iter(inque.get, None):
+            try:
+                outque.put((chunk_no, self.__get_representative_tokens(
+                    tokens_list=tokens_list, **kwargs), None))
+            except Exception as e:
+                logger.exception(e)
+                outque.put((chunk_no, None, str(e)))
 
     def update_sumav_results(self, rows, user=None, password=None,
-                             database=None, host=None, port=None, sha256=None):
-        vals = []
-        sql = ('UPDATE detection SET sumav_label=t.token '
-               'from (values %s) as t(md5, token) '
-               'where detection.md5=t.md5')
-
+                             database=None, host=None, port=None, sha256=None,
+                             commit_every=0):
+        '''Write labels of rows to detection
+
+        md5 and labels are copied to a temporary table, and detection is
+        updated by a join with it on the indexed md5. They are written by a
+        new connection so that rows can be read lazily by the searcher.
+
+        :param iterable rows: Rows having md5 and sumav_label
+        :param int commit_every: Number of rows written by a transaction. All
+            rows are written by a transaction if 0.
+        :return: Number of updated rows of detection
+        :rtype: int
+        '''
         dbkwargs = deepcopy(self._dbkwargs)
-        if (user is None and password is None and database is None and
-                host is None and port is None):
-            conn = self._conn
-        else:
-            if user is not None:
-                dbkwargs['user'] = user
-            if password is not None:
-                dbkwargs['password'] = password
-            if database is not None:
-                dbkwargs['database'] = database
-            if host is not None:
-                dbkwargs['host'] = host
-            if port is not None:
-                dbkwargs['port'] = port
-            conn = self._connect(**dbkwargs)
-
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            for i, row in enumerate(rows, 1):
-                vals.extend([self.__hex_to_bytes(row['md5']),
-                             row['sumav_label']])
-                if i % 1000 == 0:
-                    fmt_sql = sql % ','.join(['(%s,%s)']*int(len(vals)/2))
-                    cur.execute(fmt_sql, vals)
+        if user is not None:
+            dbkwargs['user'] = user
+        if password is not None:
+            dbkwargs['password'] = password
+        if database is not None:
+            dbkwargs['database'] = database
+        if host is not None:
+            dbkwargs['host'] = host
+        if port is not None:
+            dbkwargs['port'] = port
+        conn = self._connect(**dbkwargs)
+        conn.autocommit = False
+
+        pairs = (('\\x' + row['md5'] if row['md5'] is not None else None,
+                  row['sumav_label']) for row in rows)
+        updated = 0
+        try:
+            with conn.cursor() as cur:
+                while True:
+                    cur.execute('CREATE TEMP TABLE sumav_result ('
+                                '  md5 bytea,'
+                                '  sumav_label character varying(100)'
+                                ') ON COMMIT DROP')
+                    copied = self._copy_rows(
+                        cur, 'sumav_result', ['md5', 'sumav_label'],
+                        islice(pairs, commit_every) if commit_every
+                        else pairs)
+                    if copied == 0:
+                        conn.rollback()
+                        break
+
+                    cur.execute('ANALYZE sumav_result')  # To use the index
+                    cur.execute('UPDATE detection '
+                                'SET sumav_label=t.sumav_label '
+                                'FROM sumav_result AS t '
+                                'WHERE detection.md5=t.md5')
+                    updated += cur.rowcount
                     conn.commit()
-
-            if len(vals) > 0:
-                fmt_sql = sql % ','.join(['(%s,%s)']*int(len(vals)/2))
-                cur.execute(fmt_sql, vals)
-                conn.commit()
+                    logger.info('%s rows of detection are updated.' % updated)
+                    if not commit_every:
+                        break
+        except Exception:
+            try:
+                conn.rollback()
+            except psycopg2.Error:  # Not to hide the error of the update
+                pass
+            raise
+        finally:
+            conn.close()
+
+        return updated
 
     def get_metrics(self, rows=None, alias=False):
         gt_dict, out_dict = {}, {}
@@ -357,6 +1019,7 @@ class SumavGraphSearcher(SumavPostgresConnector):
     def get_graph(self, sha256=None, md5=None):
         'Get graph with dictionary form with given hash'
         self._reconnect_if_closed()
+        self.__swap_graph()
 
         if sha256 is not None:
             where, vals = 'sha256=%s', [self.__hex_to_bytes(sha256)]
@@ -366,26 +1029,43 @@ class SumavGraphSearcher(SumavPostgresConnector):
             return None
 
         with self._conn.cursor() as curs:
-            graph = {}
             curs.execute('select distinct(tokens) from detection where %s' %
                          where, vals)
             tokens = sorted(set(curs.fetchone()[0]))
-            for i, tkn1 in enumerate(tokens, 1):
-                for tkn2 in tokens[i:]:
-                    ret = self.compare_tokens(tkn1, tkn2)
-                    if ret is None:
-                        continue
-                    elif ret['relation'] == '⊃':
-                        self.__update_graph(graph, tkn1, tkn2)
 
-                    elif ret['relation'] == '⊂':
-                        self.__update_graph(graph, tkn2, tkn1)
+        # Relations of token pairs are found in the index of edges
+        graph = {}
+        edges = self.__get_edges()
+        tokens = [tkn for tkn in tokens if tkn in self.nodes]
+        for i, tkn1 in enumerate(tokens, 1):
+            for tkn2 in tokens[i:]:
+                edge = edges.edge(tkn1, tkn2)
+                if edge is None:
+                    continue
+
+                relation = self.__relation(edge[0], edge[1])
+                if relation == '⊃':
+                    self.__update_graph(graph, tkn1, tkn2)
+
+                elif relation == '⊂':
+                    self.__update_graph(graph, tkn2, tkn1)
+
+                elif relation == '=':
+                    self.__update_graph(graph, tkn1, tkn2)
+                    self.__update_graph(graph, tkn2, tkn1)
 
-                    elif ret['relation'] == '=':
-                        self.__update_graph(graph, tkn1, tkn2)
-                        self.__update_graph(graph, tkn2, tkn1)
+        return graph
 
-            return graph
+    def close(self):
+        if self.__watcher is not None:
+            os.write(self.__wakeup[1], b'\0')
+            self.__watcher.join()
+            self.__watcher = None
+            for fd in self.__wakeup:
+                os.close(fd)
+        if self.snapshot is not None:
+            self.snapshot.close()
+        super().close()
 
     def __relation(self, ratio_token, ratio_token2, intersection_ratio=0.9):
         '''Return relation symbol between tokens.
@@ -430,8 +1110,9 @@ class SumavGraphSearcher(SumavPostgresConnector):
     def __importance_func(self, token_count, row_count):
         return token_count / row_count
 
-    def __general_func(self, num_subsets, num_nodes, general_param):
-        return num_subsets / num_nodes * general_param
+    def __general_func(self, general_ratio, general_param):
+        'Generality ratio is num_subsets / (number of nodes)'
+        return general_ratio * general_param
 
     def __weight_func(self, token_count, weight_param):
         if weight_param > 1:
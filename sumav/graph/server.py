@@ -0,0 +1,413 @@
+'''
+Labeling server
+'''
+# Default packages
+import os
+import json
+import math
+import time
+import queue
+import logging
+import threading
+import socketserver
+from collections import deque
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+# 3rd-party packages
+
+# Internal packages
+import sumav.conf as conf
+import sumav.utils as utils
+
+logger = logging.getLogger(__name__)
+
+
+class SumavGraphServer:
+    '''HTTP/JSON server labeling samples with a resident SumavGraphSearcher
+
+    Requests are handled in threads and queued to a thread owning the
+    searcher. The thread takes every queued request at once, up to
+    batch_size samples, and selects representative tokens of requests having
+    the same parameters in a batch.
+
+    - POST /select: {"av_labels": [...]} or {"tokens": [...]}, or
+      {"samples": [{"av_labels": [...]}, ...]} with optional top_n,
+      weight_param, general_param, alias and return_none_less_than
+    - POST /compare: {"token": ..., "token2": ...}
+    - POST /similar: {"token": ...}
+    - GET /stats: counters of requests, batches, latency and throughput
+    '''
+    # Parameters of /select, their defaults and types
+    __params = {'top_n': (None, int), 'weight_param': (4.1, float),
+                'general_param': (225, float), 'alias': (False, bool),
+                'return_none_less_than': (0, float)}
+    max_body = 16 * 1024 * 1024  # Bytes of a request
+    __latency_window = 10000  # Recent latencies for percentiles
+
+    def __init__(self, searcher, host=conf.serve_host, port=conf.serve_port,
+                 unix_socket=None, batch_size=1000, batch_wait=0):
+        '''
+        :param SumavGraphSearcher searcher: Searcher used only by the server
+        :param str unix_socket: Path of a Unix socket to listen to instead of
+            host and port
+        :param int batch_size: Samples labeled in a batch
+        :param float batch_wait: Seconds to wait for more requests after the
+            first request of a batch. Queued requests are batched without
+            waiting if 0.
+        '''
+        self.searcher = searcher
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.unix_socket = unix_socket
+        if unix_socket is not None:
+            if os.path.exists(unix_socket):
+                os.remove(unix_socket)
+            self.httpd = _UnixHTTPServer(unix_socket, _RequestHandler)
+        else:
+            self.httpd = _HTTPServer((host, port), _RequestHandler)
+        self.httpd.sumav = self
+        self.address = self.httpd.server_address
+
+        self.__jobs = queue.Queue()
+        self.__threads = []
+        self.__lock = threading.Lock()
+        self.__started = time.time()
+        self.__counters = {'requests': 0, 'errors': 0, 'samples': 0,
+                           'batches': 0, 'batched_requests': 0}
+        self.__latencies = deque(maxlen=self.__latency_window)
+        self.__total_latency = 0.0
+        self.__max_latency = 0.0
+
+    def serve_forever(self):
+        'Serve until shutdown() is called by another thread'
+        self.__start_batching()
+        logger.info('Serving on %s.' % (self.address,))
+        self.httpd.serve_forever()
+
+    def start(self):
+        'Serve in a background thread'
+        self.__start_batching()
+        thread = threading.Thread(target=self.httpd.serve_forever,
+                                  daemon=True)
+        thread.start()
+        self.__threads.append(thread)
+        logger.info('Serving on %s.' % (self.address,))
+
+    def shutdown(self):
+        'Stop serving started by another thread and close the server'
+        self.httpd.shutdown()
+        self.close()
+
+    def close(self):
+        'Close the server after it stopped serving'
+        self.__jobs.put(None)
+        for thread in self.__threads:
+            thread.join()
+        self.__threads = []
+        self.httpd.server_close()
+        if self.unix_socket is not None and os.path.exists(self.unix_socket):
+            os.remove(self.unix_socket)
+
+    def submit(self, method, *args):
+        '''Queue a job to the batching thread and wait for its result
+
+        :param str method: select, compare or similar
+        '''
+        job = _Job(method, args)
+        self.__jobs.put(job)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+
+        return job.result
+
+    def select(self, request):
+        '''Select representative tokens of a request of /select
+
+        :return: result of a sample or results of samples
+        :rtype: dict
+        '''
+        params = {name: self.__param(name, request.get(name, default), typ)
+                  for name, (default, typ) in self.__params.items()}
+        if 'samples' in request:
+            if not isinstance(request['samples'], list):
+                raise ValueError('samples must be a list.')
+            tokens_list = [self.__tokens(sample)
+                           for sample in request['samples']]
+            return {'results': self.submit('select', tokens_list, params)}
+
+        return {'result': self.submit('select', [self.__tokens(request)],
+                                      params)[0]}
+
+    def __param(self, name, value, typ):
+        'Check the type of a parameter of /select and convert it'
+        if typ is int:
+            if value is None:
+                return None
+            elif (isinstance(value, int) and not isinstance(value, bool) and
+                    value > 0):
+                return value
+            raise ValueError('%s must be a positive integer or null.' % name)
+        elif typ is float:
+            # JSON of Python has NaN and Infinity
+            if (isinstance(value, (int, float)) and
+                    not isinstance(value, bool) and math.isfinite(value)):
+                return value
+            raise ValueError('%s must be a finite number.' % name)
+        elif isinstance(value, typ):
+            return value
+
+        raise ValueError('%s must be a %s.' % (name, typ.__name__))
+
+    def __tokens(self, sample):
+        if not isinstance(sample, dict):
+            raise ValueError('A sample must be a JSON object.')
+
+        if sample.get('tokens') is not None:
+            tokens = sample['tokens']
+            if (not isinstance(tokens, list) or
+                    not all(isinstance(t, str) for t in tokens)):
+                raise ValueError('tokens must be a list of strings.')
+            return tokens
+        elif sample.get('av_labels') is not None:
+            labels = sample['av_labels']
+            if (not isinstance(labels, list) or
+                    not all(isinstance(label, str) or label is None
+                            for label in labels)):
+                raise ValueError('av_labels must be a list of strings or '
+                                 'nulls.')
+            return utils.make_tokens(labels, remove_duplicate=False)
+
+        return None
+
+    def record(self, samples, latency, error=False):
+        'Count a request'
+        with self.__lock:
+            self.__counters['requests'] += 1
+            self.__counters['samples'] += samples
+            if error:
+                self.__counters['errors'] += 1
+            self.__latencies.append(latency)
+            self.__total_latency += latency
+            self.__max_latency = max(self.__max_latency, latency)
+
+    def stats(self):
+        '''Get counters of the server
+
+        Latencies are seconds from receiving requests to their responses.
+        Percentiles are of recent requests.
+
+        :rtype: dict
+        '''
+        with self.__lock:
+            out = dict(self.__counters)
+            latencies = sorted(self.__latencies)
+            total_latency, max_latency = (self.__total_latency,
+                                          self.__max_latency)
+
+        uptime = time.time() - self.__started
+        out['uptime'] = uptime
+        out['samples_per_sec'] = out['samples'] / uptime if uptime else 0.0
+        out['requests_per_batch'] = (
+            out['batched_requests'] / out['batches'] if out['batches']
+            else 0.0)
+        out['latency'] = {
+            'mean': (total_latency / out['requests'] if out['requests']
+                     else 0.0),
+            'max': max_latency}
+        for pct in (50, 90, 99):
+            out['latency']['p%s' % pct] = (
+                latencies[min(len(latencies) - 1,
+                              len(latencies) * pct // 100)]
+                if latencies else 0.0)
+        out['generation'] = self.searcher.generation
+        out['cache'] = self.searcher.cache_stats()
+
+        return out
+
+    def __start_batching(self):
+        thread = threading.Thread(target=self.__batch_jobs, daemon=True)
+        thread.start()
+        self.__threads.append(thread)
+
+    def __batch_jobs(self):
+        while True:
+            job = self.__jobs.get()
+            if job is None:
+                break
+
+            batch, samples = [job], self.__samples(job)
+            deadline = time.time() + self.batch_wait
+            while samples < self.batch_size:
+                try:
+                    timeout = deadline - time.time()
+                    if timeout > 0:
+                        job = self.__jobs.get(timeout=timeout)
+                    else:
+                        job = self.__jobs.get_nowait()
+                except queue.Empty:
+                    break
+
+                if job is None:
+                    self.__jobs.put(None)  # Stop after this batch
+                    break
+                batch.append(job)
+                samples += self.__samples(job)
+
+            try:
+                self.__run_batch(batch)
+            except Exception as e:  # Not to stop serving
+                logger.exception(e)
+                for job in batch:
+                    if not job.done.is_set():
+                        job.finish(error=e)
+            with self.__lock:
+                self.__counters['batches'] += 1
+                self.__counters['batched_requests'] += len(batch)
+
+    def __samples(self, job):
+        return len(job.args[0]) if job.method == 'select' else 1
+
+    def __run_batch(self, batch):
+        # Select tokens of jobs having the same parameters at once
+        groups = {}
+        for job in batch:
+            if job.method == 'select':
+                key = tuple(sorted(job.args[1].items()))
+                groups.setdefault(key, []).append(job)
+            else:
+                self.__run_job(job)
+
+        for key, jobs in groups.items():
+            try:
+                results = self.searcher.get_representative_tokens(
+                    tokens_list=[tokens for job in jobs
+                                 for tokens in job.args[0]], **dict(key))
+            except Exception as e:
+                logger.exception(e)
+                for job in jobs:
+                    job.finish(error=e)
+                continue
+
+            pos = 0
+            for job in jobs:
+                job.finish(results[pos:pos + len(job.args[0])])
+                pos += len(job.args[0])
+
+    def __run_job(self, job):
+        try:
+            if job.method == 'compare':
+                job.finish(self.searcher.compare_tokens(*job.args))
+            elif job.method == 'similar':
+                job.finish(self.searcher.get_related_tokens(*job.args))
+            else:
+                raise ValueError('Unknown method %s' % job.method)
+        except Exception as e:
+            logger.exception(e)
+            job.finish(error=e)
+
+
+class _Job:
+    def __init__(self, method, args):
+        self.method = method
+        self.args = args
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.done.set()
+
+
+class _HTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ('local', 0)
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.__reply(200, self.server.sumav.stats())
+        else:
+            self.__reply(404, {'error': 'Not found: %s' % self.path})
+
+    def do_POST(self):
+        started = time.time()
+        server, samples, status = self.server.sumav, 0, 200
+        try:
+            request = json.loads(self.__read_body(server.max_body) or b'{}')
+            if not isinstance(request, dict):
+                raise _HTTPError(400, 'Request must be a JSON object.')
+
+            if self.path == '/select':
+                samples = len(request.get('samples', [None]))
+                out = server.select(request)
+            elif self.path == '/compare':
+                out = {'result': server.submit(
+                    'compare', self.__token(request, 'token'),
+                    self.__token(request, 'token2'))}
+            elif self.path == '/similar':
+                out = {'result': server.submit(
+                    'similar', self.__token(request, 'token'))}
+            else:
+                raise _HTTPError(404, 'Not found: %s' % self.path)
+
+        except _HTTPError as e:
+            status, out = e.status, {'error': e.message}
+        except (ValueError, KeyError, TypeError) as e:
+            status, out = 400, {'error': '%s: %s' % (type(e).__name__, e)}
+        except Exception as e:
+            status, out = 500, {'error': str(e)}
+
+        self.__reply(status, out)
+        server.record(samples, time.time() - started, status != 200)
+
+    def __read_body(self, max_body):
+        length = self.headers.get('Content-Length')
+        try:
+            length = int(length)
+        except (TypeError, ValueError):
+            length = -1
+        if length < 0 or length > max_body:
+            self.close_connection = True  # The body is not read
+            if length < 0:
+                raise _HTTPError(400, 'Content-Length must be a non-negative '
+                                      'integer.')
+            raise _HTTPError(413, 'Request is too large.')
+
+        return self.rfile.read(length)
+
+    def __token(self, request, name):
+        if not isinstance(request.get(name), str):
+            raise ValueError('%s must be a string.' % name)
+
+        return request[name]
+
+    def __reply(self, status, out):
+        body = json.dumps(out).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('%s %s' % (self.address_string(), format % args))
+
+
+class _HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
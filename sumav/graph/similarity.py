@@ -0,0 +1,133 @@
+'''
+Token similarity
+'''
+# Default packages
+import logging
+import multiprocessing as mp
+from difflib import SequenceMatcher
+
+# 3rd-party packages
+
+# Internal packages
+import sumav.utils as utils
+
+logger = logging.getLogger(__name__)
+
+
+class TokenSimilarity:
+    '''Decide whether SequenceMatcher ratios of token pairs reach a threshold
+
+    The decision is the same as SequenceMatcher(a=token, b=token2).ratio() >=
+    threshold. Bounds of the ratio decide most pairs without matching them:
+
+    - The ratio is at most 2 * (matched characters) / (total length), and
+      matched characters are at most the common characters of both tokens.
+    - If a token is a substring of the other, every character of the shorter
+      one is matched.
+
+    Decisions are memoized per token pair.
+    '''
+    __cache_size = 1000000
+    __min_pairs_per_process = 10000
+
+    def __init__(self, threshold=0.65):
+        self.threshold = threshold
+        self.__cache = {}
+        self.__matcher = SequenceMatcher()
+
+    def is_similar(self, token, token2):
+        key = (token, token2)
+        similar = self.__cache.get(key)
+        if similar is None:
+            similar = self.__is_similar(token, token2)
+            if len(self.__cache) < self.__cache_size:
+                self.__cache[key] = similar
+
+        return similar
+
+    def are_similar(self, pairs, processes=1):
+        '''Decide pairs of tokens
+
+        :param list pairs: Tuples of token and token2
+        :param int processes: Number of processes deciding pairs
+        :return: decisions in the order of pairs
+        :rtype: list
+        '''
+        processes = max(1, min(processes,
+                               len(pairs) // self.__min_pairs_per_process))
+        if processes == 1:
+            return self.__decide(pairs)
+
+        # Forked whatever the default start method is because the worker is
+        # a private method, which cannot be pickled to spawn processes
+        step = -(-len(pairs) // processes)
+        ctx = mp.get_context('fork')
+        outque = ctx.Queue()
+        prs = [ctx.Process(target=self.__worker,
+                           args=(outque, chunk, pairs[lo:lo + step]))
+               for chunk, lo in enumerate(range(0, len(pairs), step))]
+        for pr in prs:
+            pr.start()
+
+        try:
+            results = {}
+            while len(results) < len(prs):
+                chunk, result, err = utils.get_from_processes(
+                    outque, [pr for i, pr in enumerate(prs)
+                             if i not in results])
+                if err is not None:
+                    raise Exception('Chunk %s failed: %s' % (chunk, err))
+                results[chunk] = result
+        finally:
+            for pr in prs:
+                if len(results) < len(prs):
+                    pr.terminate()
+                pr.join()
+
+        return [similar for chunk in range(len(prs))
+                for similar in results[chunk]]
+
+    def __worker(self, outque, chunk, pairs):
+        try:
+            outque.put((chunk, self.__decide(pairs), None))
+        except Exception as e:
+            logger.exception(e)
+            outque.put((chunk, None, str(e)))
+
+    def __decide(self, pairs):
+        # Pairs having the same token2 reuse the matcher prepared for it
+        decisions = [None] * len(pairs)
+        for i in sorted(range(len(pairs)), key=lambda i: pairs[i][1]):
+            decisions[i] = self.is_similar(*pairs[i])
+
+        return decisions
+
+    def __is_similar(self, token, token2):
+        total = len(token) + len(token2)
+        if total == 0:
+            return 1.0 >= self.threshold
+
+        if 2 * min(len(token), len(token2)) / total < self.threshold:
+            return False
+
+        if len(token) <= len(token2):
+            shorter, longer = token, token2
+        else:
+            shorter, longer = token2, token
+        if shorter in longer:
+            return 2 * len(shorter) / total >= self.threshold
+
+        char_cnt = {}
+        for c in longer:
+            char_cnt[c] = char_cnt.get(c, 0) + 1
+        common = 0
+        for c in shorter:
+            if char_cnt.get(c, 0) > 0:
+                char_cnt[c] -= 1
+                common += 1
+        if 2 * common / total < self.threshold:
+            return False
+
+        self.__matcher.set_seqs(token, token2)
+
+        return self.__matcher.ratio() >= self.threshold
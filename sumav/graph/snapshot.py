@@ -0,0 +1,243 @@
+'''
+Graph snapshot
+'''
+# Default packages
+import os
+import mmap
+import struct
+import logging
+from array import array
+from collections.abc import Mapping
+
+# 3rd-party packages
+
+# Internal packages
+
+logger = logging.getLogger(__name__)
+
+
+class GraphSnapshot:
+    '''Read-only Sumav graph memory-mapped from a snapshot file
+
+    Processes mapping the same file share its pages. Nodes are indexed in the
+    byte order of their tokens. The file consists of a header and sections
+    aligned to 8 bytes.
+
+    - Token table: offsets of tokens in a blob of UTF-8 tokens
+    - Nodes: id, token_count, row_count, token_ratio, num_subsets, alias (-1
+      if a node has no alias), importance and generality arrays
+    - Parents: offsets of parents of each node and their indexes
+    - Edges: offsets of edges of each node, indexes of the other nodes,
+      p(other|node), p(node|other) and intersection_row_count. Every edge is
+      stored in both directions and ordered by the other node.
+    '''
+    __magic = b'SUMAVGS2'
+    __header = struct.Struct('=8s5q')  # Magic, generation and section sizes
+    __node_arrays = [('id', 'q'), ('token_count', 'q'), ('row_count', 'q'),
+                     ('token_ratio', 'd'), ('num_subsets', 'q'),
+                     ('alias', 'q'), ('importance', 'd'),
+                     ('generality', 'd')]
+    __edge_arrays = [('edge_other', 'i'), ('p_other', 'd'), ('p_node', 'd'),
+                     ('edge_count', 'q')]
+    # Edges of token_edge in both directions in the order of write()
+    edge_sql = ('SELECT * FROM ('
+                '  SELECT token,token2,"p(token2|token)",'
+                '  "p(token|token2)",intersection_row_count '
+                '  FROM token_edge UNION ALL '
+                '  SELECT token2,token,"p(token|token2)",'
+                '  "p(token2|token)",intersection_row_count '
+                '  FROM token_edge) AS e '
+                'ORDER BY token COLLATE "C",token2 COLLATE "C"')
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.__mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = memoryview(self.__mm)
+
+        (magic, generation, num_nodes, blob_size, num_parents,
+         num_edges) = self.__header.unpack_from(buf)
+        if magic != self.__magic:
+            raise ValueError('%s is not a Sumav graph snapshot.' % path)
+        self.generation = None if generation < 0 else generation
+        self.num_nodes = num_nodes
+
+        pos = self.__header.size
+        self.__views = [buf]
+        for size, typecode in self.__sections(num_nodes, blob_size,
+                                              num_parents, num_edges):
+            end = pos + size * array(typecode).itemsize
+            if typecode == 'B':
+                self.__blob_pos = pos  # Tokens are read as bytes of mmap
+            else:
+                self.__views.append(buf[pos:end].cast(typecode))
+            pos = self.__align(end)
+
+        self.token_offsets, views = self.__views[1], self.__views[2:]
+        for (name, _), view in zip(self.__node_arrays, views):
+            setattr(self, name, view)
+        views = views[len(self.__node_arrays):]
+        self.parent_offsets, self.parents = views[:2]
+        self.edge_offsets = views[2]
+        for (name, _), view in zip(self.__edge_arrays, views[3:]):
+            setattr(self, name, view)
+
+    def __len__(self):
+        return self.num_nodes
+
+    def token(self, idx):
+        return self.__token_bytes(idx).decode()
+
+    def index(self, token):
+        'Return the index of token or -1 if it is not a node'
+        key = token.encode()
+        lo, hi = 0, self.num_nodes
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.__token_bytes(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.num_nodes and self.__token_bytes(lo) == key:
+            return lo
+
+        return -1
+
+    def __token_bytes(self, idx):
+        pos = self.__blob_pos
+        return self.__mm[pos + self.token_offsets[idx]:
+                         pos + self.token_offsets[idx + 1]]
+
+    def node(self, idx):
+        'Return a node in the form of a row of token_node'
+        alias = self.alias[idx]
+        return {'id': self.id[idx], 'token': self.token(idx),
+                'alias': self.token(alias) if alias >= 0 else 'None',
+                'parents': [self.token(p) for p in self.parents[
+                    self.parent_offsets[idx]:self.parent_offsets[idx + 1]]],
+                'token_count': self.token_count[idx],
+                'row_count': self.row_count[idx],
+                'token_ratio': self.token_ratio[idx],
+                'num_subsets': self.num_subsets[idx],
+                'importance': self.importance[idx],
+                'generality': self.generality[idx]}
+
+    def close(self):
+        for view in reversed(self.__views):
+            view.release()
+        self.__mm.close()
+
+    @classmethod
+    def write(cls, path, nodes, edges, generation=None):
+        '''Write a snapshot file
+
+        The file is replaced at once so that processes mapping the previous
+        file keep reading it.
+
+        :param iterable nodes: Rows of id, token, alias, parents, token_count,
+            row_count, token_ratio, num_subsets, importance and generality
+            ordered by token in the byte order
+        :param iterable edges: Rows of token, token2, p(token2|token),
+            p(token|token2) and intersection_row_count of both directions
+            ordered by token and token2 in the byte order
+        :param int generation: Id of the build of the graph
+        '''
+        nodes = list(nodes)
+        index = {node[1]: idx for idx, node in enumerate(nodes)}
+
+        token_offsets, blob = array('q', [0]), bytearray()
+        node_arrays = [array(typecode) for _, typecode in cls.__node_arrays]
+        parent_offsets, parents = array('q', [0]), array('q')
+        for (node_id, tkn, alias, node_parents, tkn_cnt, row_cnt, tkn_ratio,
+             num_subsets, importance, generality) in nodes:
+            blob += tkn.encode()
+            token_offsets.append(len(blob))
+            for arr, val in zip(node_arrays, (
+                    node_id, tkn_cnt, row_cnt, tkn_ratio, num_subsets,
+                    index[alias] if alias not in (None, 'None') else -1,
+                    importance, generality)):
+                arr.append(val)
+            parents.extend(index[p] for p in node_parents or [])
+            parent_offsets.append(len(parents))
+        del nodes
+
+        edge_offsets = array('q', [0] * (len(index) + 1))
+        edge_arrays = [array(typecode) for _, typecode in cls.__edge_arrays]
+        for tkn, tkn2, p_token2, p_token, cnt in edges:
+            edge_offsets[index[tkn] + 1] += 1
+            for arr, val in zip(edge_arrays, (index[tkn2], p_token2, p_token,
+                                               cnt)):
+                arr.append(val)
+        for idx in range(len(index)):
+            edge_offsets[idx + 1] += edge_offsets[idx]
+
+        sections = [token_offsets, bytes(blob)] + node_arrays + [
+            parent_offsets, parents, edge_offsets] + edge_arrays
+        with open(path + '.tmp', 'wb') as f:
+            f.write(cls.__header.pack(
+                cls.__magic, -1 if generation is None else generation,
+                len(index), len(blob), len(parents), len(edge_arrays[0])))
+            for section in sections:
+                f.write(section)
+                f.write(b'\0' * (cls.__align(f.tell()) - f.tell()))
+        os.replace(path + '.tmp', path)
+        logger.info('Snapshot of %s nodes and %s edges is written to %s.' %
+                    (len(index), len(edge_arrays[0]) // 2, path))
+
+    @classmethod
+    def __sections(cls, num_nodes, blob_size, num_parents, num_edges):
+        'Return lengths and typecodes of sections'
+        return ([(num_nodes + 1, 'q'), (blob_size, 'B')] +
+                [(num_nodes, typecode) for _, typecode in cls.__node_arrays] +
+                [(num_nodes + 1, 'q'), (num_parents, 'q'),
+                 (num_nodes + 1, 'q')] +
+                [(num_edges, typecode) for _, typecode in cls.__edge_arrays])
+
+    @staticmethod
+    def __align(pos):
+        return -(-pos // 8) * 8
+
+
+class SnapshotNodes(Mapping):
+    'Nodes of a snapshot mapped from tokens to rows of token_node'
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __getitem__(self, token):
+        idx = self.snapshot.index(token)
+        if idx < 0:
+            raise KeyError(token)
+
+        return self.snapshot.node(idx)
+
+    def __contains__(self, token):
+        return self.snapshot.index(token) >= 0
+
+    def __iter__(self):
+        return (self.snapshot.token(idx) for idx in range(len(self)))
+
+    def __len__(self):
+        return len(self.snapshot)
+
+
+class SnapshotAliases(Mapping):
+    'Aliases of nodes of a snapshot. A node without alias is mapped to itself.'
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __getitem__(self, token):
+        idx = self.snapshot.index(token)
+        if idx < 0:
+            raise KeyError(token)
+
+        alias = self.snapshot.alias[idx]
+        return self.snapshot.token(alias) if alias >= 0 else token
+
+    def __contains__(self, token):
+        return self.snapshot.index(token) >= 0
+
+    def __iter__(self):
+        return (self.snapshot.token(idx) for idx in range(len(self)))
+
+    def __len__(self):
+        return len(self.snapshot)
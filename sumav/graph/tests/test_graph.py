@@ -2,8 +2,19 @@
 # Default packages
 import os
 import sys
+import json
+import time
+import socket
+import signal
+import asyncio
+import random
 import logging
+import multiprocessing as mp
+from array import array
 from pprint import pprint
+from difflib import SequenceMatcher
+from http.client import HTTPConnection
+from concurrent.futures import ThreadPoolExecutor
 
 # 3rd-party packages
 import pytest
@@ -11,12 +22,82 @@ import pytest
 # Internal packages
 import sumav.conf as conf
 from sumav import (SumavGraphBuilder, SumavGraphManager, SumavGraphSearcher,
+                   SumavGraphAsyncSearcher, SumavGraphServer,
                    FromVirusTotalFileFeed)
+from sumav.graph.disjointset import DisjointSet
+from sumav.graph.edgecounter import EdgeCounter
+from sumav.graph.edgeindex import EdgeIndex
+from sumav.graph.similarity import TokenSimilarity
 
 logging.basicConfig(level=logging.INFO, stream=sys.stdout)
 logger = logging.getLogger(__name__)
 
 
+class TestDisjointSet:
+    def test_union_by_weight(self):
+        weights = [1, 5, 5, 2]
+        alias_set = DisjointSet(len(weights), weights)
+        assert alias_set.union(0, 1)
+        assert alias_set.union(2, 1)
+        assert not alias_set.union(0, 2)
+        assert [alias_set.find(x) for x in range(4)] == [2, 2, 2, 3]
+
+    def test_long_chain(self):
+        size = sys.getrecursionlimit() * 2
+        alias_set = DisjointSet(size, list(range(size)))
+        for x in range(size - 1):
+            alias_set.union(x, x + 1)
+        assert alias_set.find(0) == size - 1
+
+
+class TestEdgeCounter:
+    def test_merge_runs(self, monkeypatch, tmp_path):
+        monkeypatch.setattr(EdgeCounter, '_EdgeCounter__fan_in', 4)
+        random.seed(0)
+        counter, expected = EdgeCounter(50, str(tmp_path)), {}
+        for _ in range(5000):
+            key = random.randrange(1000)
+            counter.counts[key] = counter.counts.get(key, 0) + 1
+            expected[key] = expected.get(key, 0) + 1
+            counter.spill_if_full()
+        _, _, runs = counter.result()
+        assert len(runs) > 4 ** 2  # Merged by two intermediate passes
+
+        keys, counts = array('Q'), array('q')
+        for chunk_keys, chunk_counts in EdgeCounter.merge_runs(
+                runs, 50, str(tmp_path)):
+            assert len(chunk_keys) <= 50
+            keys.extend(chunk_keys)
+            counts.extend(chunk_counts)
+
+        assert list(zip(keys, counts)) == list(expected.items())
+        assert os.listdir(str(tmp_path)) == []
+
+
+class TestTokenSimilarity:
+    def test_are_similar(self):
+        random.seed(0)
+        pairs = []
+        for _ in range(20000):
+            pair = [''.join(random.choice('abcdefgh') for _ in
+                            range(random.randint(4, 12))) for _ in range(2)]
+            if random.random() < 0.2:
+                pair[1] = pair[0][random.randint(0, 3):]
+            pairs.append(tuple(pair))
+        expected = [SequenceMatcher(a=a, b=b).ratio() >= 0.65
+                    for a, b in pairs]
+
+        assert TokenSimilarity(0.65).are_similar(pairs) == expected
+        assert TokenSimilarity(0.65).are_similar(pairs, 2) == expected
+
+        start_method = mp.get_start_method()
+        mp.set_start_method('spawn', force=True)
+        try:
+            assert TokenSimilarity(0.65).are_similar(pairs, 2) == expected
+        finally:
+            mp.set_start_method(start_method, force=True)
+
+
 class TestGraphBuilder:
     @classmethod
     def setup_class(cls):
@@ -43,6 +124,221 @@ class TestGraphBuilder:
         assert graph_size['node_size'] > 0
         assert graph_size['edge_size'] > 0
 
+    def test_node_scores(self):
+        builder = SumavGraphBuilder(**conf.psql_conf)
+        builder.build_graph()
+        with builder._conn.cursor() as cur:
+            cur.execute('SELECT count(*) FROM token_node WHERE '
+                        'importance IS DISTINCT FROM '
+                        'token_count::float8/row_count OR '
+                        'generality IS DISTINCT FROM num_subsets::float8/'
+                        '(SELECT count(*) FROM token_node)')
+            wrong = cur.fetchone()[0]
+        builder.close()
+
+        assert wrong == 0
+
+    @pytest.mark.parametrize('mode,single_pass', [('python', False),
+                                                  ('python', True),
+                                                  ('sql', False)])
+    def test_incremental_builder(self, mode, single_pass):
+        builder = SumavGraphBuilder(**conf.psql_conf)
+        builder.build_graph()
+        full_graph = self.__get_graph(builder)
+
+        # Build a graph with the first half of detections and add the rest
+        with builder._conn.cursor() as cur:
+            cur.execute('SELECT percentile_disc(0.5) WITHIN GROUP '
+                        '(ORDER BY id) FROM detection')
+            half_id = cur.fetchone()[0]
+            cur.execute('CREATE TEMP TABLE detection_rest AS '
+                        'SELECT * FROM detection WHERE id>%s', [half_id])
+            cur.execute('DELETE FROM detection WHERE id>%s', [half_id])
+        builder._conn.commit()
+        builder.build_graph()
+
+        with builder._conn.cursor() as cur:
+            cur.execute('INSERT INTO detection SELECT * FROM detection_rest')
+        builder._conn.commit()
+        builder.build_graph(incremental=True, mode=mode,
+                            single_pass=single_pass)
+        incremental_graph = self.__get_graph(builder)
+        builder.close()
+
+        assert incremental_graph == full_graph
+
+    def test_rollback_graph(self):
+        builder = SumavGraphBuilder(**conf.psql_conf)
+        with builder._conn.cursor() as cur:
+            cur.execute('SELECT percentile_disc(0.5) WITHIN GROUP '
+                        '(ORDER BY id) FROM detection')
+            half_id = cur.fetchone()[0]
+            cur.execute('CREATE TEMP TABLE detection_rest AS '
+                        'SELECT * FROM detection WHERE id>%s', [half_id])
+            cur.execute('DELETE FROM detection WHERE id>%s', [half_id])
+        builder._conn.commit()
+        builder.build_graph()
+        half_graph = self.__get_graph(builder, with_id=True)
+
+        with builder._conn.cursor() as cur:
+            cur.execute('INSERT INTO detection SELECT * FROM detection_rest')
+        builder._conn.commit()
+        builder.build_graph(incremental=True)
+        assert self.__get_graph(builder, with_id=True) != half_graph
+
+        builder.rollback_graph()
+        rolled_back_graph = self.__get_graph(builder, with_id=True)
+        with builder._conn.cursor() as cur:
+            cur.execute('SELECT last_detection_id FROM graph_build_log '
+                        'ORDER BY id DESC LIMIT 1')
+            last_detection_id = cur.fetchone()[0]
+        with pytest.raises(Exception):
+            builder.rollback_graph()
+        builder.close()
+
+        assert rolled_back_graph == half_graph
+        assert last_detection_id == half_id
+
+    def test_multiprocess_builder(self):
+        builder = SumavGraphBuilder(**conf.psql_conf)
+        builder.build_graph(processes=1)
+        single_graph = self.__get_graph(builder, with_id=True)
+        builder.build_graph(processes=4)
+        multi_graph = self.__get_graph(builder, with_id=True)
+        builder.close()
+
+        assert multi_graph == single_graph
+
+    def test_multiprocess_builder_spawn(self):
+        builder = SumavGraphBuilder(**conf.psql_conf)
+        builder.build_graph(processes=1)
+        single_graph = self.__get_graph(builder, with_id=True)
+
+        # Default of macOS and of Linux from Python 3.14
+        start_method = mp.get_start_method()
+        mp.set_start_method('spawn', force=True)
+        try:
+            builder.build_graph(processes=2)
+        finally:
+            mp.set_start_method(start_method, force=True)
+        multi_graph = self.__get_graph(builder, with_id=True)
+        builder.close()
+
+        assert multi_graph == single_graph
+
+    def test_killed_shard(self, monkeypatch):
+        count_nodes = SumavGraphBuilder._SumavGraphBuilder__count_nodes
+
+        def killed(self, cur, shard, *args):
+            if shard == 1:
+                os.kill(os.getpid(), signal.SIGKILL)  # As the OOM killer
+            return count_nodes(self, cur, shard, *args)
+        monkeypatch.setattr(SumavGraphBuilder,
+                            '_SumavGraphBuilder__count_nodes', killed)
+
+        builder = SumavGraphBuilder(**conf.psql_conf)
+        started = time.time()
+        with pytest.raises(Exception, match='without putting'):
+            builder.build_graph(processes=2)
+        builder._conn.rollback()
+        builder.close()
+
+        assert time.time() - started < 60
+
+    @pytest.mark.parametrize('processes', [1, 2])
+    def test_memory_limited_builder(self, processes):
+        builder = SumavGraphBuilder(**conf.psql_conf)
+        builder.build_graph(processes=processes, memory_limit=0)
+        unlimited_graph = self.__get_graph(builder, with_id=True)
+        builder.build_graph(processes=processes, memory_limit=0.01)
+        limited_graph = self.__get_graph(builder, with_id=True)
+        builder.close()
+
+        assert limited_graph == unlimited_graph
+
+    def test_single_pass_builder(self):
+        builder = SumavGraphBuilder(**conf.psql_conf)
+        builder.build_graph(processes=2)
+        two_pass_graph = self.__get_graph(builder, with_id=True)
+        builder.build_graph(processes=2, single_pass=True)
+        single_pass_graph = self.__get_graph(builder, with_id=True)
+        builder.close()
+
+        assert single_pass_graph == two_pass_graph
+
+    @pytest.mark.parametrize('single_pass', [False, True])
+    def test_dedup_builder(self, single_pass):
+        builder = SumavGraphBuilder(**conf.psql_conf)
+        builder.build_graph(processes=2, single_pass=single_pass)
+        expected_graph = self.__get_graph(builder, with_id=True)
+        builder.build_graph(processes=2, single_pass=single_pass, dedup=True)
+        dedup_graph = self.__get_graph(builder, with_id=True)
+        builder.close()
+
+        assert dedup_graph == expected_graph
+
+    def test_numpy_builder(self):
+        pytest.importorskip('numpy')
+        builder = SumavGraphBuilder(**conf.psql_conf)
+        builder.build_graph(use_numpy=False)
+        python_graph = self.__get_graph(builder, with_id=True)
+        builder.build_graph(use_numpy=True)
+        numpy_graph = self.__get_graph(builder, with_id=True)
+        builder.close()
+
+        assert numpy_graph == python_graph
+
+    def test_resume_builder(self, monkeypatch, tmp_path):
+        checkpoint = str(tmp_path / 'build.ckpt')
+        builder = SumavGraphBuilder(**conf.psql_conf)
+        builder.build_graph()
+        expected_graph = self.__get_graph(builder, with_id=True)
+
+        def fail(*args):
+            raise RuntimeError('failed')
+
+        # Crash in step 4 and resume from the checkpoint of step 3
+        with monkeypatch.context() as m:
+            m.setattr(SumavGraphBuilder,
+                      '_SumavGraphBuilder__insert_nodes_and_edges', fail)
+            with pytest.raises(RuntimeError):
+                builder.build_graph(checkpoint=checkpoint)
+        builder._conn.rollback()
+        assert os.path.exists(checkpoint)
+
+        with monkeypatch.context() as m:
+            m.setattr(SumavGraphBuilder,
+                      '_SumavGraphBuilder__build_token_graph', fail)
+            builder.build_graph(checkpoint=checkpoint)
+        resumed_graph = self.__get_graph(builder, with_id=True)
+        builder.close()
+
+        assert not os.path.exists(checkpoint)
+        assert resumed_graph == expected_graph
+
+    def test_sql_builder(self):
+        builder = SumavGraphBuilder(**conf.psql_conf)
+        builder.build_graph(mode='python')
+        python_graph = self.__get_graph(builder, with_id=True)
+        builder.build_graph(mode='sql')
+        sql_graph = self.__get_graph(builder, with_id=True)
+        builder.close()
+
+        assert sql_graph == python_graph
+
+    def __get_graph(self, builder, with_id=False):
+        with builder._conn.cursor() as cur:
+            cur.execute('SELECT id,token,alias,parents,token_count,'
+                        'row_count,token_ratio,num_subsets FROM token_node '
+                        'ORDER BY token')
+            nodes = [r if with_id else r[1:] for r in cur.fetchall()]
+            cur.execute('SELECT id,token,token2,"p(token2|token)",'
+                        '"p(token|token2)",intersection_row_count '
+                        'FROM token_edge ORDER BY token,token2')
+            edges = [r if with_id else r[1:] for r in cur.fetchall()]
+
+        return nodes, edges
+
 
 class TestGraphManager:
     @classmethod
@@ -94,6 +390,53 @@ class TestGraphManager:
 
         assert dumped_graph_cnt == 1
 
+    def test_search_pulled_graph(self):
+        for graph_name in self.__manager.get_sumav_graph_list(remote=False):
+            if graph_name.startswith('sumav_test_'):
+                self.__manager.remove_sumav_graph(graph_name, remote=False)
+        graph_name = self.__manager.dump_sumav_graph('sumav_test',
+                                                     remote=False)
+        psql_conf = dict(conf.psql_conf, database=graph_name)
+        expected = SumavGraphSearcher(**conf.psql_conf)
+        searcher = SumavGraphSearcher(**psql_conf)
+        assert searcher.generation == expected.generation
+        assert (searcher.get_representative_token(tokens=['virlock']) ==
+                expected.get_representative_token(tokens=['virlock']))
+        searcher.close()
+
+        # Graphs dumped before the build log and node scores are added
+        with self.__manager._connect(**psql_conf) as conn:
+            with conn.cursor() as cur:
+                cur.execute('DROP TABLE graph_build_log,token_stat')
+                cur.execute('ALTER TABLE token_node DROP COLUMN importance,'
+                            'DROP COLUMN generality')
+            with conn.cursor() as cur:
+                cur.execute("DROP ROLE IF EXISTS sumav_reader")
+                cur.execute("CREATE ROLE sumav_reader LOGIN "
+                            "PASSWORD 'reader'")
+                cur.execute('GRANT SELECT ON ALL TABLES IN SCHEMA public '
+                            'TO sumav_reader')
+        conn.close()
+
+        # Read as it is by a role which cannot migrate it, and migrated
+        for user, password in [('sumav_reader', 'reader'),
+                               (conf.psql_conf['user'],
+                                conf.psql_conf['password'])]:
+            searcher = SumavGraphSearcher(**dict(psql_conf, user=user,
+                                                 password=password))
+            assert searcher.generation is None
+            assert (searcher.get_representative_token(tokens=['virlock']) ==
+                    expected.get_representative_token(tokens=['virlock']))
+            assert (searcher.compare_tokens('win32', 'ransom') ==
+                    expected.compare_tokens('win32', 'ransom'))
+            searcher.close()
+        expected.close()
+
+        self.__manager.remove_sumav_graph(graph_name, remote=False)
+        with self.__manager._conn.cursor() as cur:
+            cur.execute('DROP ROLE sumav_reader')
+        self.__manager._conn.commit()
+
 class TestGraphSearcher:
     @classmethod
     def setup_class(cls):
@@ -121,6 +464,51 @@ class TestGraphSearcher:
     def teardown(self):
         self.__searcher.close()
 
+    def test_read_only_role(self):
+        with self.__searcher._conn.cursor() as cur:
+            cur.execute("DROP ROLE IF EXISTS sumav_reader")
+            cur.execute("CREATE ROLE sumav_reader LOGIN PASSWORD 'reader'")
+            cur.execute('GRANT SELECT ON ALL TABLES IN SCHEMA public '
+                        'TO sumav_reader')
+        psql_conf = dict(conf.psql_conf, user='sumav_reader',
+                         password='reader')
+
+        try:
+            searcher = SumavGraphSearcher(**psql_conf)
+            assert searcher.get_representative_token(
+                tokens=['virlock']) == 'virlock'
+            searcher.close()
+        finally:
+            with self.__searcher._conn.cursor() as cur:
+                cur.execute('DROP OWNED BY sumav_reader')
+                cur.execute('DROP ROLE sumav_reader')
+
+    def test_read_only_role_after_build(self):
+        with self.__searcher._conn.cursor() as cur:
+            cur.execute("DROP ROLE IF EXISTS sumav_reader")
+            cur.execute("CREATE ROLE sumav_reader LOGIN PASSWORD 'reader'")
+            cur.execute('GRANT SELECT ON ALL TABLES IN SCHEMA public '
+                        'TO sumav_reader')
+        psql_conf = dict(conf.psql_conf, user='sumav_reader',
+                         password='reader')
+
+        try:
+            # Tables replaced by the build must keep the privileges
+            builder = SumavGraphBuilder(**conf.psql_conf)
+            builder.build_graph()
+            builder.close()
+
+            searcher = SumavGraphSearcher(**psql_conf)
+            assert searcher.get_representative_token(
+                tokens=['virlock']) == 'virlock'
+            assert (searcher.compare_tokens('win32', 'ransom') ==
+                    self.__searcher.compare_tokens('win32', 'ransom'))
+            searcher.close()
+        finally:
+            with self.__searcher._conn.cursor() as cur:
+                cur.execute('DROP OWNED BY sumav_reader')
+                cur.execute('DROP ROLE sumav_reader')
+
     def test_compare_tokens(self):
         result = self.__searcher.compare_tokens('win32', 'ransom')
         pprint(result)
@@ -134,6 +522,32 @@ class TestGraphSearcher:
         assert 'winlock' in result['subsets']
         assert 'win32' in result['supersets']
 
+    def test_get_graph_relations(self):
+        rows = list(self.__searcher.get_detection_rows(limit=30))
+        found = False
+        for row in rows:
+            graph = self.__searcher.get_graph(sha256=row['sha256'])
+            found = found or len(graph) > 0
+
+            # Subsets are tokens which appear with supersets over 90%
+            tokens = list(set(row['tokens']))
+            expected = {}
+            with self.__searcher._conn.cursor() as cur:
+                cur.execute('SELECT token,token2,"p(token2|token)",'
+                            '"p(token|token2)" FROM token_edge '
+                            'WHERE token=ANY(%s) AND token2=ANY(%s)',
+                            [tokens, tokens])
+                for tkn, tkn2, p_token2, p_token in cur:
+                    if p_token2 > 0.9:  # tkn ⊂ tkn2
+                        expected.setdefault(tkn2, []).append(tkn)
+                    if p_token > 0.9:  # tkn ⊃ tkn2
+                        expected.setdefault(tkn, []).append(tkn2)
+
+            assert ({tkn: sorted(subsets) for tkn, subsets in graph.items()} ==
+                    {tkn: sorted(subsets)
+                     for tkn, subsets in expected.items()})
+        assert found
+
     def test_get_representative_token(self):
         dn = [
             'Win32/Nabucur', 'Win32:VirLock', 'Win32.Virus.Virlock.a',
@@ -145,6 +559,365 @@ class TestGraphSearcher:
 
         assert result[0][0] == 'virlock'
 
+    @pytest.mark.parametrize('top_n, alias', [(None, False), (3, True)])
+    def test_get_representative_tokens(self, top_n, alias):
+        tokens_list = [row['tokens'] for row in
+                       self.__searcher.get_detection_rows()] + [None, []]
+        results = self.__searcher.get_representative_tokens(
+            tokens_list=tokens_list, top_n=top_n, alias=alias,
+            **self.__kwparams)
+        pprint(results[:3])
+
+        assert results == [self.__searcher.get_representative_token(
+            tokens=tokens, top_n=top_n, alias=alias, **self.__kwparams)
+            for tokens in tokens_list]
+
+    def test_general_params(self):
+        tokens_list = [row['tokens'] for row in
+                       self.__searcher.get_detection_rows(limit=100)]
+        for general_param in range(200):
+            assert self.__searcher.get_representative_tokens(
+                tokens_list=tokens_list, general_param=general_param) == [
+                    self.__searcher.get_representative_token(
+                        tokens=tokens, general_param=general_param)
+                    for tokens in tokens_list]
+
+        # Terms of the default and the last general_param are kept
+        generality = self.__searcher._SumavGraphSearcher__node_scores[3]
+        assert sorted(generality) == [199, 225]
+
+    def test_get_representative_tokens_of_hashes(self):
+        rows = list(self.__searcher.get_detection_rows())
+        sha256_list = [row['sha256'].upper() for row in rows] + ['00' * 32]
+        results = self.__searcher.get_representative_tokens(
+            sha256_list=sha256_list, top_n=3, **self.__kwparams)
+
+        assert results == [self.__searcher.get_representative_token(
+            sha256=sha256, top_n=3, **self.__kwparams)
+            for sha256 in sha256_list]
+        assert results[-1] is None
+        assert self.__searcher.get_representative_tokens(
+            md5_list=[row['md5'] for row in rows]) == [
+                r['sumav_label'] for r in
+                self.__searcher.get_sumav_results(rows, **self.__kwparams)]
+
+    def test_cache(self):
+        rows = list(self.__searcher.get_detection_rows())
+        expected = list(self.__searcher.get_sumav_results(
+            rows, **self.__kwparams))
+
+        searcher = SumavGraphSearcher(**conf.psql_conf, cache_size=50)
+        for _ in range(2):
+            assert list(searcher.get_sumav_results(
+                rows, **self.__kwparams)) == expected
+            assert [searcher.get_representative_token(
+                tokens=row['tokens'], **self.__kwparams)
+                for row in rows] == [r['sumav_label'] for r in expected]
+        stats = searcher.cache_stats()
+        pprint(stats)
+        assert stats['entries'] == 50
+        assert stats['hits'] > 0 and stats['evictions'] > 0
+
+        searcher.generation += 1  # The graph is built again
+        searcher.get_representative_token(tokens=rows[0]['tokens'])
+        searcher.close()
+        assert searcher.cache_stats()['entries'] == 1
+        assert searcher.cache_stats()['invalidations'] == 1
+
+    @pytest.mark.parametrize('start_method', ['fork', 'spawn'])
+    def test_get_sumav_results_multiprocess(self, monkeypatch, start_method):
+        monkeypatch.setattr(SumavGraphSearcher,
+                            '_SumavGraphSearcher__batch_size', 50)
+        rows = list(self.__searcher.get_detection_rows())
+        default_method = mp.get_start_method()
+        mp.set_start_method(start_method, force=True)
+        try:
+            results = list(self.__searcher.get_sumav_results(
+                iter(rows), processes=2, **self.__kwparams))
+        finally:
+            mp.set_start_method(default_method, force=True)
+
+        assert results == list(
+            self.__searcher.get_sumav_results(rows, **self.__kwparams))
+
+    def test_reload_graph(self):
+        searcher = SumavGraphSearcher(**conf.psql_conf)
+        generation = searcher.generation
+        assert not searcher.reload_graph()
+
+        builder = SumavGraphBuilder(**conf.psql_conf)
+        builder.build_graph()
+        builder.close()
+        assert searcher.reload_graph()
+        searcher.close()
+
+        assert searcher.generation > generation
+
+    def test_watch_graph(self):
+        searcher = SumavGraphSearcher(**conf.psql_conf)
+        generation = searcher.generation
+        searcher.watch_graph(interval=60)  # Notified by the builder
+
+        builder = SumavGraphBuilder(**conf.psql_conf)
+        builder.build_graph()
+        builder.close()
+
+        deadline = time.time() + 10
+        while searcher.generation == generation and time.time() < deadline:
+            time.sleep(0.1)
+            searcher.get_representative_token(tokens=['virlock'])
+        searcher.close()
+
+        assert searcher.generation > generation
+
+    @pytest.mark.parametrize('notified', [True, False])
+    def test_watch_graph_without_snapshot(self, monkeypatch, tmp_path,
+                                          notified):
+        snapshot = str(tmp_path / 'graph.snap')
+        builder = SumavGraphBuilder(**conf.psql_conf)
+        builder.write_snapshot(snapshot)
+        searcher = SumavGraphSearcher(**conf.psql_conf, snapshot=snapshot)
+        assert searcher.snapshot is not None
+        generation = searcher.generation
+        monkeypatch.setattr(SumavGraphSearcher,
+                            '_SumavGraphSearcher__snapshot_timeout', 1)
+        searcher.watch_graph(interval=0.2)
+        time.sleep(0.5)  # Listening
+
+        # A build not writing the snapshot makes it stale
+        if not notified:
+            monkeypatch.setattr(conf, 'graph_channel', 'sumav_missed')
+        builder.build_graph(snapshot=None)
+        builder.close()
+
+        deadline = time.time() + 10
+        while searcher.generation == generation and time.time() < deadline:
+            time.sleep(0.1)
+            searcher.get_representative_token(tokens=['virlock'])
+        searcher.close()
+
+        assert searcher.generation > generation
+        assert searcher.snapshot is None
+
+    def test_async_searcher(self):
+        rows = list(self.__searcher.get_detection_rows())[:300]
+        expected = [self.__searcher.get_representative_token(
+            sha256=row['sha256'], top_n=3) for row in rows]
+
+        async def label():
+            async with SumavGraphAsyncSearcher(**conf.psql_conf,
+                                               connections=4) as searcher:
+                results = await asyncio.gather(*[
+                    searcher.get_representative_token(sha256=row['sha256'],
+                                                      top_n=3)
+                    for row in rows])
+                assert results == expected
+                assert await searcher.get_representative_tokens(
+                    sha256_list=[row['sha256'] for row in rows],
+                    top_n=3) == expected
+                assert await searcher.get_representative_token(
+                    md5=rows[0]['md5'], top_n=3) == expected[0]
+                assert await searcher.get_representative_token(
+                    md5='00' * 16) is None
+                assert (await searcher.compare_tokens('win32', 'ransom') ==
+                        self.__searcher.compare_tokens('win32', 'ransom'))
+
+        async def close():
+            # Queued lookups do not block the loop while closing
+            searcher = SumavGraphAsyncSearcher(**conf.psql_conf,
+                                               connections=1)
+            get_tokens = searcher.searcher.get_tokens_of_hashes
+
+            def slow(*args):
+                time.sleep(1)
+                return get_tokens(*args)
+            searcher.searcher.get_tokens_of_hashes = slow
+            lookup = asyncio.ensure_future(searcher.get_representative_token(
+                sha256=rows[0]['sha256'], top_n=3))
+            await asyncio.sleep(0.1)
+
+            ticks = 0
+
+            async def tick():
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0.05)
+                    ticks += 1
+            ticker = asyncio.ensure_future(tick())
+            await searcher.__aexit__(None, None, None)
+            ticker.cancel()
+            assert ticks > 5
+            assert await lookup == expected[0]
+
+        asyncio.run(label())
+        asyncio.run(close())
+
+    @pytest.mark.parametrize('unix', [False, True])
+    def test_server(self, tmp_path, unix):
+        unix_socket = str(tmp_path / 'sumav.sock') if unix else None
+        server = SumavGraphServer(SumavGraphSearcher(**conf.psql_conf),
+                                  port=0, unix_socket=unix_socket)
+        server.start()
+
+        def request(path, body=None, length=None):
+            if unix:
+                conn = HTTPConnection('localhost', timeout=10)
+                conn.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                conn.sock.connect(unix_socket)
+                conn.sock.settimeout(10)
+            else:
+                conn = HTTPConnection(*server.address, timeout=10)
+            if body is None:
+                conn.request('GET', path)
+            elif length is None:
+                conn.request('POST', path, json.dumps(body))
+            else:
+                conn.putrequest('POST', path)
+                if length:
+                    conn.putheader('Content-Length', length)
+                conn.endheaders(json.dumps(body).encode())
+            resp = conn.getresponse()
+            out = json.loads(resp.read())
+            conn.close()
+            return resp.status, out
+
+        rows = list(self.__searcher.get_detection_rows())[:200]
+        with ThreadPoolExecutor(8) as pool:
+            results = list(pool.map(lambda row: request(
+                '/select', {'tokens': row['tokens']}), rows))
+        assert results == [(200, {'result': r['sumav_label']}) for r in
+                           self.__searcher.get_sumav_results(rows)]
+
+        status, out = request('/select', {'samples': [
+            {'tokens': row['tokens']} for row in rows[:5]], 'top_n': 3})
+        assert status == 200
+        assert out['results'] == [json.loads(json.dumps(
+            self.__searcher.get_representative_token(
+                tokens=row['tokens'], top_n=3))) for row in rows[:5]]
+        assert request('/compare', {'token': 'win32', 'token2': 'ransom'}
+                       )[1]['result']['relation'] == '⊃'
+        assert 'winlock' in request(
+            '/similar', {'token': 'ransom'})[1]['result']['subsets']
+        assert request('/compare', {'token': 'win32'})[0] == 400
+
+        status, stats = request('/stats')
+
+        # Invalid requests neither stop the server nor wait forever
+        for body in [{'tokens': ['virlock'], 'top_n': [1]},
+                     {'tokens': ['virlock'], 'alias': 1},
+                     {'tokens': 'virlock'}, {'samples': [['virlock']]},
+                     {'av_labels': [1]},
+                     {'tokens': ['virlock'], 'general_param': float('nan')},
+                     {'tokens': ['virlock'], 'weight_param': float('inf')}]:
+            assert request('/select', body)[0] == 400
+        assert request('/similar', {'token': ['ransom']})[0] == 400
+        for length in ['', '-1', 'x']:
+            assert request('/select', {'tokens': ['virlock']},
+                           length)[0] == 400
+
+        def fail(batch):
+            raise RuntimeError('Batch failed')
+        server._SumavGraphServer__run_batch = fail
+        assert request('/select', {'tokens': ['virlock']})[0] == 500
+        del server._SumavGraphServer__run_batch
+        assert request('/select', {'tokens': ['virlock']}) == (
+            200, {'result': 'virlock'})
+        server.shutdown()
+        server.searcher.close()
+        pprint(stats)
+        assert stats['requests'] == len(rows) + 4
+        assert stats['samples'] == len(rows) + 5
+        assert stats['errors'] == 1
+        assert stats['batches'] <= stats['batched_requests'] == len(rows) + 3
+        assert stats['latency']['p99'] <= stats['latency']['max']
+        assert not unix or not os.path.exists(unix_socket)
+
+    def test_watch_graph_retries(self, monkeypatch):
+        searcher = SumavGraphSearcher(**conf.psql_conf)
+        searcher.compare_tokens('win32', 'ransom')  # Edges are loaded too
+        generation = searcher.generation
+
+        from_rows, failures = EdgeIndex.from_rows, []
+
+        def fail_once(*args):
+            if not failures:
+                failures.append(True)
+                raise KeyError('token')
+            return from_rows(*args)
+        monkeypatch.setattr(EdgeIndex, 'from_rows', fail_once)
+        searcher.watch_graph(interval=0.2)
+
+        builder = SumavGraphBuilder(**conf.psql_conf)
+        builder.build_graph()
+        builder.close()
+
+        deadline = time.time() + 10
+        while searcher.generation == generation and time.time() < deadline:
+            time.sleep(0.1)
+            searcher.get_representative_token(tokens=['virlock'])
+        result = searcher.compare_tokens('win32', 'ransom')
+        searcher.close()
+
+        assert failures
+        assert searcher.generation > generation
+        assert result == self.__searcher.compare_tokens('win32', 'ransom')
+
+    def test_snapshot(self, tmp_path):
+        snapshot = str(tmp_path / 'graph.snap')
+        builder = SumavGraphBuilder(**conf.psql_conf)
+        builder.write_snapshot(snapshot)
+        builder.close()
+
+        searcher = SumavGraphSearcher(**conf.psql_conf, snapshot=snapshot)
+        assert searcher.snapshot is not None
+        assert len(searcher.nodes) == len(self.__searcher.nodes)
+        for tkn, node in self.__searcher.nodes.items():
+            assert searcher.nodes[tkn] == dict(node)
+            assert searcher.alias[tkn] == self.__searcher.alias[tkn]
+
+        for tkn in ['win32', 'ransom', 'winlock']:
+            assert (searcher.get_related_tokens(tkn) ==
+                    self.__searcher.get_related_tokens(tkn))
+            assert (searcher.compare_tokens('win32', tkn) ==
+                    self.__searcher.compare_tokens('win32', tkn))
+
+        rows = list(self.__searcher.get_detection_rows())
+        results = list(searcher.get_sumav_results(rows, **self.__kwparams))
+        searcher.close()
+
+        assert results == list(
+            self.__searcher.get_sumav_results(rows, **self.__kwparams))
+
+    @pytest.mark.parametrize('commit_every', [0, 100])
+    def test_update_sumav_results(self, commit_every):
+        rows = list(self.__searcher.get_detection_rows())
+        results = [dict(r, sumav_label='%s-%s' % (r['sumav_label'],
+                                                   commit_every))
+                   for r in self.__searcher.get_sumav_results(
+                       rows, **self.__kwparams)]
+        updated = self.__searcher.update_sumav_results(
+            rows=iter(results), commit_every=commit_every)
+
+        assert updated == len(rows)
+        assert [row['sumav_label'] for row in
+                self.__searcher.get_detection_rows()] == [
+                    r['sumav_label'] for r in results]
+
+    @pytest.mark.parametrize('commit_every', [0, 100])
+    def test_update_sumav_results_lazily(self, commit_every):
+        # Rows are read by the connection of the searcher while writing
+        searcher = self.__searcher
+        updated = searcher.update_sumav_results(
+            searcher.get_sumav_results(searcher.get_detection_rows(),
+                                       **self.__kwparams),
+            commit_every=commit_every)
+
+        rows = list(searcher.get_detection_rows())
+        assert updated == len(rows)
+        assert [row['sumav_label'] for row in rows] == [
+            r['sumav_label'] for r in
+            searcher.get_sumav_results(rows, **self.__kwparams)]
+
     def test_get_metrics(self):
         # load detections
         rows = list(self.__searcher.get_detection_rows())
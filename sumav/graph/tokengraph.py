@@ -0,0 +1,164 @@
+'''
+Token graph
+'''
+# Default packages
+from array import array
+
+# 3rd-party packages
+
+# Internal packages
+
+
+class TokenGraph:
+    '''Token graph whose tokens are interned to integers
+
+    Attributes of tokens and edges are stored in typed arrays indexed by the
+    token index and the edge position. An edge is keyed by a packed integer
+    of its token indexes where token is lexicographically less than token2.
+    '''
+    def __init__(self):
+        # Every counted token including rare tokens which are not nodes
+        self.tokens = []
+        self.index = {}
+        self.token_count = array('q')
+        self.row_count = array('q')
+
+        # Node attributes. node_id is 0 if the token is not a node.
+        self.node_id = array('q')
+        self.token_ratio = array('d')
+        self.num_subsets = array('q')
+        self.alias = array('q')  # -1 if the node has no alias
+        self.parents = {}
+        self.last_node_id = 0
+
+        # Edge attributes in the order that edges are counted first
+        self.edge_index = {}
+        self.edge_key = array('Q')
+        self.edge_id = array('q')
+        self.edge_count = array('q')
+        self.p_token2 = array('d')  # p(token2|token)
+        self.p_token = array('d')  # p(token|token2)
+        self.last_edge_id = 0
+
+    def __getstate__(self):
+        # Indexes are built again after unpickling to keep pickles compact
+        state = self.__dict__.copy()
+        del state['index'], state['edge_index']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.index = {tkn: idx for idx, tkn in enumerate(self.tokens)}
+        self.edge_index = None  # Built when it is required
+
+    @staticmethod
+    def pair(idx, idx2):
+        return idx << 32 | idx2
+
+    @staticmethod
+    def unpair(key):
+        return key >> 32, key & 0xffffffff
+
+    def intern(self, token):
+        'Return the index of token. The token is added if it does not exist.'
+        idx = self.index.get(token)
+        if idx is None:
+            idx = len(self.tokens)
+            self.index[token] = idx
+            self.tokens.append(token)
+            for arr in (self.token_count, self.row_count, self.node_id,
+                        self.num_subsets):
+                arr.append(0)
+            self.token_ratio.append(0.0)
+            self.alias.append(-1)
+
+        return idx
+
+    def add_token_counts(self, tokens, token_counts, row_counts):
+        'Add counts of tokens and return their indexes'
+        indexes = []
+        for tkn, tkn_cnt, row_cnt in zip(tokens, token_counts, row_counts):
+            idx = self.intern(tkn)
+            self.token_count[idx] += tkn_cnt
+            self.row_count[idx] += row_cnt
+            indexes.append(idx)
+
+        return indexes
+
+    def add_node(self, idx, node_id=None):
+        if node_id is None:
+            node_id = self.last_node_id + 1
+        self.node_id[idx] = node_id
+        self.last_node_id = max(self.last_node_id, node_id)
+
+    def remove_node(self, idx):
+        self.node_id[idx] = 0
+        self.alias[idx] = -1
+        self.num_subsets[idx] = 0
+        self.parents.pop(idx, None)
+
+    def node_indexes(self):
+        return [idx for idx, node_id in enumerate(self.node_id) if node_id]
+
+    def node_index(self):
+        'Return a dictionary from tokens of nodes to their indexes'
+        return {self.tokens[idx]: idx for idx in self.node_indexes()}
+
+    def add_edge_counts(self, keys, counts, unique=False):
+        '''Add counts of edges
+
+        :param bool unique: Keys are not in the graph and not duplicated. The
+            edges are appended without indexing them to save memory.
+        '''
+        if unique:
+            self.edge_index = None  # Index again when it is required
+            for key, cnt in zip(keys, counts):
+                self.add_edge(key, cnt)
+            return
+
+        if self.edge_index is None:
+            self.edge_index = {key: pos for pos, key in
+                               enumerate(self.edge_key)}
+        for key, cnt in zip(keys, counts):
+            pos = self.edge_index.get(key)
+            if pos is None:
+                self.add_edge(key, cnt)
+            else:
+                self.edge_count[pos] += cnt
+
+    def add_edge(self, key, count, edge_id=None, p_token2=float('nan'),
+                 p_token=float('nan')):
+        if edge_id is None:
+            edge_id = self.last_edge_id + 1
+        if self.edge_index is not None:
+            self.edge_index[key] = len(self.edge_key)
+        self.edge_key.append(key)
+        self.edge_id.append(edge_id)
+        self.edge_count.append(count)
+        self.p_token2.append(p_token2)
+        self.p_token.append(p_token)
+        self.last_edge_id = max(self.last_edge_id, edge_id)
+
+    def remove_edges(self, indexes):
+        '''Remove edges having one of token indexes
+
+        :return: indexes of the other tokens of removed edges
+        :rtype: set
+        '''
+        others = set()
+        keep = []
+        for pos, key in enumerate(self.edge_key):
+            idx, idx2 = self.unpair(key)
+            if idx in indexes or idx2 in indexes:
+                others.add(idx)
+                others.add(idx2)
+            else:
+                keep.append(pos)
+
+        for name in ('edge_key', 'edge_id', 'edge_count', 'p_token2',
+                     'p_token'):
+            arr = getattr(self, name)
+            setattr(self, name, array(arr.typecode, [arr[p] for p in keep]))
+        self.edge_index = {key: pos for pos, key in enumerate(self.edge_key)}
+
+        return others - set(indexes)
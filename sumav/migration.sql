@@ -0,0 +1,46 @@
+--
+-- Tables added after the initial schema. Every statement must be idempotent
+-- because this file is executed on connections to databases missing any of
+-- them. Update SumavPostgresConnector.__needs_migration() when adding one.
+--
+
+--
+-- Name: token_stat; Type: TABLE; Schema: public; Owner: sumav
+-- Raw counts of every token including rare tokens pruned from token_node.
+--
+
+CREATE TABLE IF NOT EXISTS public.token_stat (
+    token character varying(100) NOT NULL PRIMARY KEY,
+    token_count integer NOT NULL,
+    row_count integer NOT NULL
+);
+
+--
+-- Name: graph_build_log; Type: TABLE; Schema: public; Owner: sumav
+--
+
+CREATE TABLE IF NOT EXISTS public.graph_build_log (
+    id serial NOT NULL PRIMARY KEY,
+    last_detection_id bigint NOT NULL,
+    incremental boolean NOT NULL,
+    "timestamp" timestamp with time zone NOT NULL
+);
+
+--
+-- Name: token_node; Type: TABLE; Schema: public; Owner: sumav
+-- Static score terms of nodes: importance = token_count / row_count and
+-- generality = num_subsets / (number of nodes). Columns are checked before
+-- altering the table not to lock it on each connection.
+--
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+                   WHERE table_schema = 'public' AND
+                         table_name = 'token_node' AND
+                         column_name = 'importance') THEN
+        ALTER TABLE public.token_node
+            ADD COLUMN importance double precision,
+            ADD COLUMN generality double precision;
+    END IF;
+END $$;
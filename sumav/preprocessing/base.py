@@ -39,6 +39,11 @@ class PreprocessingBase(SumavPostgresConnector):
             cur.execute('TRUNCATE TABLE file_feed_log')
             cur.execute('TRUNCATE TABLE token_edge')
             cur.execute('TRUNCATE TABLE token_node')
+            cur.execute('TRUNCATE TABLE token_stat')
+            cur.execute('TRUNCATE TABLE graph_build_log')
+            cur.execute('DROP TABLE IF EXISTS token_edge_old,token_node_old,'
+                        'token_stat_old,token_edge_new,token_node_new,'
+                        'token_stat_new')
 
     def detection_count(self):
         with self._conn.cursor() as c:
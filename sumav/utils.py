@@ -4,6 +4,7 @@ Utilities
 # Default packages
 import os
 import re
+import queue
 import logging
 
 # 3rd-party packages
@@ -50,6 +51,30 @@ def explore_dir(file_or_dir_paths, include_dir=False):
     return paths
 
 
+def get_from_processes(que, processes, timeout=1):
+    '''Get an item put in que by processes
+
+    Processes are checked whenever nothing is put for timeout seconds, so
+    that a process killed before putting its result, e.g. by the OOM killer,
+    fails the wait instead of blocking it forever.
+
+    :param Queue que:
+    :param list processes: Processes expected to put items in que
+    :param float timeout: Seconds between checks of processes
+    :return: an item of que
+    '''
+    while True:
+        try:
+            return que.get(timeout=timeout)
+        except queue.Empty:
+            pass
+
+        for pr in processes:
+            if pr.exitcode not in (None, 0):
+                raise Exception('%s exited with code %s without putting its '
+                                'result.' % (pr.name, pr.exitcode))
+
+
 def make_tokens(detection_names, remove_duplicate=True):
     tokens = []
     tkn_ptn = re.compile("^[a-z]+[0-9]{0,2}[a-z]*$")